@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of the basic agents.
+
+Everything runs locally - web targets and the Overwatch Hub report endpoint
+are replaced by stub servers (see stub_servers.py), log files are generated.
+Results are printed (or written with --output) as JSON, so that they can be
+stored and compared with another run using --compare.
+
+Example:
+
+    python3 benchmarks/run_benchmarks.py --log-size-mb 2048 --output bench.json
+    python3 benchmarks/run_benchmarks.py --compare bench.json
+'''
+
+import argparse
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from time import monotonic as monotime
+from time import time
+
+project_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_dir))
+
+from stub_servers import StubServer
+
+
+logger = logging.getLogger(__name__)
+
+all_cases = ['log', 'web', 'system', 'report']
+
+log_error_patterns = [
+    '" 500 ',
+    '" 502 ',
+    '" 503 ',
+    '" 504 ',
+    r'\bERROR\b',
+    r'\bFATAL\b',
+    'Traceback',
+    'upstream timed out',
+    r'"(POST|PUT) /api/[^ ]*/payments',
+    r'rt=[1-9][0-9]\.[0-9]+$',
+]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--verbose', '-v', action='count')
+    p.add_argument('--cases', default=','.join(all_cases), help='comma-separated subset of: ' + ', '.join(all_cases))
+    p.add_argument('--work-dir', help='directory for generated files (kept between runs); temporary by default')
+    p.add_argument('--log-size-mb', type=float, default=100, help='total size of generated log files')
+    p.add_argument('--log-files', type=int, default=4, help='number of generated log files')
+    p.add_argument('--log-scan-workers', type=int, default=1, help='log agent scan.workers')
+    p.add_argument('--log-process-pool', action='store_true', help='log agent scan.process_pool')
+    p.add_argument('--web-targets', type=int, default=50)
+    p.add_argument('--web-latency', type=float, default=0.05, help='response latency of stub web targets in seconds')
+    p.add_argument('--web-workers', type=int, default=20)
+    p.add_argument('--https', action='store_true', help='serve stub web targets over HTTPS (needs openssl command)')
+    p.add_argument('--system-iterations', type=int, default=20)
+    p.add_argument('--report-count', type=int, default=200)
+    p.add_argument('--report-error-lines', type=int, default=1000, help='size of the sample report')
+    p.add_argument('--output', '-o', help='write results JSON to this file')
+    p.add_argument('--compare', help='compare results with a previous results JSON file')
+    args = p.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(name)-20s %(levelname)5s: %(message)s',
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    cases = args.cases.split(',')
+    for case in cases:
+        if case not in all_cases:
+            p.error('Unknown case: {}'.format(case))
+
+    if args.work_dir:
+        work_dir = Path(args.work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        results = run_benchmarks(cases, args, work_dir)
+    else:
+        with tempfile.TemporaryDirectory(prefix='overwatch-bench-') as tmp:
+            results = run_benchmarks(cases, args, Path(tmp))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text())
+        print_comparison(previous, results, file=sys.stderr if not args.output else sys.stdout)
+
+
+def run_benchmarks(cases, args, work_dir):
+    results = {
+        'meta': get_meta(args),
+        'results': {},
+    }
+    with StubServer() as hub:
+        for case in cases:
+            logger.info('Running benchmark %s', case)
+            t0 = monotime()
+            f = globals()['bench_' + case]
+            results['results'][case] = f(args, work_dir, hub)
+            results['results'][case]['wall_time_s'] = monotime() - t0
+    return results
+
+
+def get_meta(args):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=str(project_dir), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {
+        'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': vars(args),
+    }
+
+
+class CountingSender:
+    '''
+    Replacement of ReportSender that only counts reports; used where report
+    posting should not be part of the measurement.
+    '''
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, conf, report_data):
+        self.count += 1
+
+    def get_stats(self, agent=None):
+        return {}
+
+
+def write_conf(work_dir, section, hub, extra):
+    conf_path = work_dir / '{}.yaml'.format(section)
+    data = {
+        section: dict({
+            'report_url': hub.url + '/report',
+            'report_token': 'bench',
+        }, **extra),
+    }
+    conf_path.write_text(json.dumps(data))  # JSON is valid YAML
+    return conf_path
+
+
+def generate_log_file(path, size_bytes, seed):
+    '''
+    Generates nginx-like access log; about 1 % of lines are errors.
+    '''
+    if path.exists() and path.stat().st_size == size_bytes:
+        return
+    rnd = random.Random(seed)
+    paths = ['/', '/static/app.js', '/api/v1/users/{}', '/api/v1/orders/{}/payments', '/search?q={}']
+    agents = [
+        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+        'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+        'curl/8.4.0',
+    ]
+    lines = []
+    for n in range(5000):
+        status = rnd.choice([500, 502, 503]) if rnd.random() < 0.01 else rnd.choice([200, 200, 200, 301, 304, 404])
+        lines.append('10.{}.{}.{} - - [10/Oct/2026:13:55:{:02d} +0000] "{} {} HTTP/1.1" {} {} "-" "{}" rt={:.3f}\n'.format(
+            rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), n % 60,
+            rnd.choice(['GET', 'GET', 'GET', 'POST']),
+            rnd.choice(paths).format(rnd.randrange(100000)),
+            status, rnd.randrange(100, 50000), rnd.choice(agents), rnd.expovariate(20)).encode())
+    block = b''.join(lines)
+    with path.open('wb') as f:
+        written = 0
+        while written + len(block) <= size_bytes:
+            f.write(block)
+            written += len(block)
+        rest = block[:size_bytes - written]
+        f.write(rest[:rest.rfind(b'\n') + 1].ljust(size_bytes - written, b'\n'))
+
+
+def bench_log(args, work_dir, hub):
+    from overwatch_basic_agents.log_agent import Configuration, LogAgent
+    size_bytes = int(args.log_size_mb * 2**20 / args.log_files)
+    log_files = []
+    for n in range(args.log_files):
+        path = work_dir / 'access-{}.log'.format(n)
+        generate_log_file(path, size_bytes, seed=n)
+        log_files.append({
+            'path': path.name,
+            'error_patterns': [{'regex': r} for r in log_error_patterns],
+        })
+    line_count = 0
+    for lf in log_files:
+        with (work_dir / lf['path']).open('rb') as f:
+            line_count += sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(2**20), b''))
+    conf = Configuration(write_conf(work_dir, 'overwatch_log_agent', hub, {
+        'log_files': log_files,
+        'scan': {
+            'workers': args.log_scan_workers,
+            'process_pool': args.log_process_pool,
+            # measure the whole backlog in one iteration
+            'file_time_budget': 10**9,
+        },
+    }))
+    agent = LogAgent(conf, CountingSender())
+    t0 = monotime()
+    agent.run_iteration()
+    duration = monotime() - t0
+    agent._shutdown_pools()
+    total_bytes = size_bytes * args.log_files
+    return {
+        'scan_workers': args.log_scan_workers,
+        'process_pool': args.log_process_pool,
+        'lines': line_count,
+        'bytes': total_bytes,
+        'duration_s': duration,
+        'lines_per_s': line_count / duration,
+        'mb_per_s': total_bytes / 2**20 / duration,
+    }
+
+
+def bench_web(args, work_dir, hub):
+    from overwatch_basic_agents.helpers import ReportSender
+    from overwatch_basic_agents.web_agent import Configuration, WebAgent, create_check_session
+    cert_dir = work_dir if args.https else None
+    with StubServer(latency=args.web_latency, cert_dir=cert_dir) as target_server:
+        targets = [
+            {'url': '{}/target/{}'.format(target_server.url, n), 'response_contains': 'Pong'}
+            for n in range(args.web_targets)
+        ]
+        conf = Configuration(write_conf(work_dir, 'overwatch_web_agent', hub, {
+            'watch': targets,
+            'workers': args.web_workers,
+        }))
+        agent = WebAgent(conf, ReportSender())
+        agent.check_session = create_check_session(args.web_workers)
+        if target_server.cert_file:
+            agent.check_session.verify = str(target_server.cert_file)
+        posts_before = hub.post_count
+        durations = []
+        for i in range(3):
+            t0 = monotime()
+            agent.run_iteration()
+            durations.append(monotime() - t0)
+        assert hub.post_count - posts_before == 3 * args.web_targets
+    best = min(durations)
+    return {
+        'targets': args.web_targets,
+        'latency_s': args.web_latency,
+        'workers': args.web_workers,
+        'https': bool(args.https),
+        'iteration_durations_s': durations,
+        'targets_per_s': args.web_targets / best,
+    }
+
+
+def bench_system(args, work_dir, hub):
+    from overwatch_basic_agents import system_agent
+    collectors = {
+        'cpu': lambda: system_agent.gather_cpu(),
+        'load': lambda: system_agent.gather_load(),
+        'uptime': lambda: system_agent.gather_uptime(),
+        'volumes': lambda: system_agent.gather_volumes(),
+        'memory': lambda: system_agent.gather_memory(),
+        'swap': lambda: system_agent.gather_swap(),
+        'processes': lambda: system_agent.gather_processes(system_agent.Processes(None)),
+        'pressure': lambda: system_agent.gather_pressure(system_agent.Pressure(None)),
+    }
+    results = {'collectors_ms': {}}
+    for name, f in collectors.items():
+        f()
+        t0 = monotime()
+        for i in range(args.system_iterations):
+            f()
+        results['collectors_ms'][name] = 1000 * (monotime() - t0) / args.system_iterations
+    # outward IP lookups go to the internet, so they are left out of gather_state
+    originals = system_agent.gather_outward_ip4, system_agent.gather_outward_ip6
+    system_agent.gather_outward_ip4 = system_agent.gather_outward_ip6 = lambda: None
+    try:
+        t0 = monotime()
+        for i in range(args.system_iterations):
+            system_agent.gather_state(conf=None)
+        results['gather_state_ms'] = 1000 * (monotime() - t0) / args.system_iterations
+    finally:
+        system_agent.gather_outward_ip4, system_agent.gather_outward_ip6 = originals
+    return results
+
+
+def sample_report(error_lines):
+    return {
+        'label': {'agent': 'log', 'host': 'bench.example.com'},
+        'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'state': {
+            'log_files': {
+                '/var/log/nginx/access.log': {
+                    'path': '/var/log/nginx/access.log',
+                    'size_bytes': 123456789,
+                    'last_error_lines': {
+                        '{}:{}'.format(time(), n): {
+                            'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                            'line': '10.0.0.{} - - [10/Oct/2026:13:55:36 +0000] "GET /api/v1/orders/{} HTTP/1.1" 500 1234'.format(n % 256, n),
+                        } for n in range(error_lines)
+                    },
+                    'last_error_date': {'__value': None, '__check': {'state': 'green'}},
+                },
+            },
+        },
+    }
+
+
+def bench_report(args, work_dir, hub):
+    from overwatch_basic_agents.helpers import ReportSender
+
+    class conf:
+        report_url = hub.url + '/report'
+        report_token = 'bench'
+
+    sender = ReportSender()
+    report = sample_report(args.report_error_lines)
+    sender.send(conf, report)
+    posts_before = hub.post_count
+    bytes_before = hub.post_bytes
+    latencies = []
+    for i in range(args.report_count):
+        t0 = monotime()
+        sender.send(conf, report)
+        latencies.append(monotime() - t0)
+    assert hub.post_count - posts_before == args.report_count
+    latencies.sort()
+    return {
+        'reports': args.report_count,
+        'report_bytes': (hub.post_bytes - bytes_before) // args.report_count,
+        'reports_per_s': args.report_count / sum(latencies),
+        'latency_mean_ms': 1000 * sum(latencies) / len(latencies),
+        'latency_p95_ms': 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+    }
+
+
+def flatten(data, prefix=''):
+    for k, v in data.items():
+        if isinstance(v, dict):
+            yield from flatten(v, prefix + k + '.')
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield prefix + k, v
+
+
+def print_comparison(previous, current, file):
+    prev_values = dict(flatten(previous['results']))
+    print('{:45} {:>14} {:>14} {:>8}'.format('metric', 'previous', 'current', 'change'), file=file)
+    for k, v in flatten(current['results']):
+        if k not in prev_values:
+            continue
+        pv = prev_values[k]
+        change = '{:+.1f} %'.format(100 * (v - pv) / pv) if pv else ''
+        print('{:45} {:14.3f} {:14.3f} {:>8}'.format(k, pv, v, change), file=file)
+
+
+if __name__ == '__main__':
+    main()
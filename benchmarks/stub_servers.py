@@ -0,0 +1,110 @@
+'''
+Local HTTP(S) servers used by the benchmarks instead of real targets and
+a real Overwatch Hub.
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from pathlib import Path
+import ssl
+import subprocess
+import threading
+from time import sleep
+
+
+logger = logging.getLogger(__name__)
+
+
+class _QuietHTTPServer (ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the web agent SSL certificate check does not trust our self-signed
+        # certificate, so failed handshakes are expected here
+        logger.debug('Error processing request from %s', client_address, exc_info=True)
+
+
+class StubServer:
+    '''
+    Threaded HTTP server running in a background thread.
+
+    GET requests are answered after `latency` seconds with a body of
+    `body_size` bytes; POST requests (reports) are read, counted and
+    answered with "ok".
+    '''
+
+    def __init__(self, latency=0, body_size=1024, cert_dir=None):
+        self.latency = latency
+        self.body = (b'Pong ' * (body_size // 5 + 1))[:body_size]
+        self.post_count = 0
+        self.post_bytes = 0
+        self.lock = threading.Lock()
+        self.httpd = _QuietHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.cert_file = None
+        if cert_dir:
+            self.cert_file = generate_self_signed_cert(Path(cert_dir))
+            cx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            cx.load_cert_chain(str(self.cert_file))
+            # handshake happens in the request handler thread, not in the accept loop
+            self.httpd.socket = cx.wrap_socket(self.httpd.socket, server_side=True, do_handshake_on_connect=False)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        scheme = 'https' if self.cert_file else 'http'
+        return '{}://localhost:{}'.format(scheme, self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler (BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+            # headers and body are sent separately; avoid delayed ACK stalls
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if server.latency:
+                    sleep(server.latency)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(server.body)))
+                self.end_headers()
+                self.wfile.write(server.body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                with server.lock:
+                    server.post_count += 1
+                    server.post_bytes += len(body)
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def generate_self_signed_cert(cert_dir):
+    '''
+    Generates certificate + key for localhost using the openssl command.
+    '''
+    cert_file = cert_dir / 'localhost.pem'
+    if not cert_file.exists():
+        subprocess.run([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-days', '2', '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+            '-keyout', str(cert_file), '-out', str(cert_file),
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file
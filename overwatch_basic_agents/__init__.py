@@ -1,3 +1,23 @@
-from .log_agent import log_agent_main
-from .system_agent import system_agent_main
-from .web_agent import web_agent_main
+# The agent modules are imported only when their entry point is called,
+# so that running one agent does not import the dependencies of the others
+# (psutil, requests, ssl).
+
+
+def log_agent_main():
+    from .log_agent import log_agent_main
+    return log_agent_main()
+
+
+def multi_agent_main():
+    from .multi_agent import multi_agent_main
+    return multi_agent_main()
+
+
+def system_agent_main():
+    from .system_agent import system_agent_main
+    return system_agent_main()
+
+
+def web_agent_main():
+    from .web_agent import web_agent_main
+    return web_agent_main()
@@ -1,2 +1,6 @@
-from .configuration import BaseConfiguration
+from .configuration import BaseConfiguration, ConfigurationWatcher, load_configuration_file, reuse_unchanged
 from .logging import setup_logging, setup_log_file
+from .profiling import ProfilerHook, SamplingProfiler
+from .reporting import ReportSender, add_watchdog, encode_report, format_date, get_fqdn, get_report_label, value
+from .sampling import SampleBuffer
+from .self_metrics import gather_self_metrics
@@ -1,5 +1,8 @@
+import json
 import logging
+import os
 from pathlib import Path
+import signal
 import yaml
 
 
@@ -10,11 +13,15 @@ class BaseConfiguration:
 
     top_level_key = None
 
-    def __init__(self, conf_file_path):
+    def __init__(self, conf_file_path, data=None):
+        '''
+        Parameter data can be used to pass already parsed configuration file
+        contents, so that it does not have to be read again for every agent.
+        '''
         self.conf_file_path = Path(conf_file_path).resolve()
         base_path = self.conf_file_path.parent
-        with self.conf_file_path.open() as f:
-            data = yaml.safe_load(f.read())
+        if data is None:
+            data = load_configuration_file(self.conf_file_path)
         assert self.top_level_key
         cfg_data = data[self.top_level_key]
         self._load(cfg_data, base_path)
@@ -25,6 +32,85 @@ class BaseConfiguration:
         self.log = _Log(data.get('log'), base_path)
         self.sleep_interval = _float_or_none(data.get('sleep_interval'))
         self.watchdog_interval = _float_or_none(data.get('watchdog_interval'))
+        self.profiling = _Profiling(data.get('profiling'), base_path)
+
+
+def load_configuration_file(conf_file_path):
+    with Path(conf_file_path).open() as f:
+        return yaml.safe_load(f.read())
+
+
+class ConfigurationWatcher:
+    '''
+    Detects that the configuration file should be reloaded, either because
+    it was modified (mtime, size or inode has changed) or because the process
+    has received SIGHUP.
+    '''
+
+    def __init__(self, conf_file_path):
+        self.conf_file_path = Path(conf_file_path)
+        self.file_id = self._get_file_id()
+        self.reload_requested = False
+
+    def install_signal_handler(self):
+        signal.signal(signal.SIGHUP, self._handle_sighup)
+
+    def _handle_sighup(self, signum, frame):
+        self.reload_requested = True
+
+    def _get_file_id(self):
+        try:
+            st = os.stat(str(self.conf_file_path))
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_dev, st.st_ino)
+
+    def check(self):
+        '''
+        Returns True if configuration should be reloaded.
+        '''
+        file_id = self._get_file_id()
+        changed = file_id is not None and file_id != self.file_id
+        if changed or self.reload_requested:
+            logger.info(
+                'Configuration file %s %s', self.conf_file_path,
+                'has changed' if changed else 'reload requested by SIGHUP')
+            self.file_id = file_id
+            self.reload_requested = False
+            return True
+        return False
+
+    def load_if_changed(self, conf_class):
+        '''
+        Returns new configuration object, or None if the configuration
+        has not changed or if the new configuration is not valid.
+        '''
+        if not self.check():
+            return None
+        try:
+            return conf_class(self.conf_file_path)
+        except Exception as e:
+            logger.error('Failed to load configuration %s, keeping the current one: %r', self.conf_file_path, e)
+            return None
+
+
+def reuse_unchanged(old_items, new_items):
+    '''
+    Returns new_items, but with items whose configuration (the data attribute)
+    is the same as of some item in old_items replaced by that old item.
+    That way the old items keep their state (open files, caches, ...) across
+    configuration reload.
+    '''
+    def key(item):
+        return json.dumps(item.data, sort_keys=True, default=str)
+    available = {}
+    for item in old_items:
+        available.setdefault(key(item), []).append(item)
+    result = []
+    for item in new_items:
+        same = available.get(key(item))
+        result.append(same.pop(0) if same else item)
+    return result
 
 
 def _float_or_none(v):
@@ -41,3 +127,15 @@ class _Log:
         if data:
             if data.get('file'):
                 self.file_path = base_path / data['file']
+
+
+class _Profiling:
+
+    def __init__(self, data, base_path):
+        data = data or {}
+        self.enabled = bool(data.get('enabled'))
+        # start profiling right away (at start, or when turned on by configuration reload)
+        self.start = self.enabled and bool(data.get('start'))
+        self.output_dir = base_path / (data.get('output_dir') or '.')
+        self.duration = _float_or_none(data.get('duration')) or 30
+        self.interval = _float_or_none(data.get('interval')) or 0.01
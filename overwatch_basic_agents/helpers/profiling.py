@@ -0,0 +1,122 @@
+from collections import Counter
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+import signal
+import sys
+import threading
+from time import monotonic as monotime
+from time import sleep
+
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    '''
+    Periodically samples stacks of all threads of the running process and
+    writes them to a file in the "collapsed stacks" format (one line per
+    distinct stack: "frame;frame;frame count"), which can be turned into
+    a flame graph for example by flamegraph.pl or speedscope.
+    '''
+
+    def __init__(self, output_dir, duration, interval):
+        self.output_dir = Path(output_dir)
+        self.duration = duration
+        self.interval = interval
+        self.thread = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            logger.info('Profiler is already running')
+            return
+        self.thread = threading.Thread(target=self._run, name='SamplingProfiler', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            logger.info('Profiling for %.1f s', self.duration)
+            stacks = self.sample()
+            path = self.write(stacks)
+            logger.info('Profile written to %s', path)
+        except Exception as e:
+            logger.exception('Profiling failed: %r', e)
+
+    def sample(self):
+        own_thread_id = threading.get_ident()
+        stacks = Counter()
+        deadline = monotime() + self.duration
+        while monotime() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stacks[format_stack(frame)] += 1
+            sleep(self.interval)
+        return stacks
+
+    def write(self, stacks):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        path = self.output_dir / 'overwatch-profile-{}-{}.txt'.format(
+            os.getpid(), datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))
+        with path.open('w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        return path
+
+
+def format_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class ProfilerHook:
+    '''
+    Starts SamplingProfiler when the process receives SIGUSR2 (if profiling
+    is enabled in configuration) or when the configuration says so.
+
+    Call configure() from the main thread at startup and after every
+    configuration reload.
+    '''
+
+    def __init__(self):
+        self.profiler = None
+        self.signal_handler_installed = False
+        self.start_configured = False
+
+    def configure(self, profiling_conf):
+        if not profiling_conf.enabled:
+            self.profiler = None
+            self.start_configured = False
+            return
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(
+                output_dir=profiling_conf.output_dir,
+                duration=profiling_conf.duration,
+                interval=profiling_conf.interval)
+        else:
+            # keep the same profiler, so that a reload does not start another one
+            # while it is running; new settings are used from its next run
+            self.profiler.output_dir = Path(profiling_conf.output_dir)
+            self.profiler.duration = profiling_conf.duration
+            self.profiler.interval = profiling_conf.interval
+        if not self.signal_handler_installed:
+            signal.signal(signal.SIGUSR2, self._handle_signal)
+            self.signal_handler_installed = True
+        # start only when the start option is turned on, not on every reload
+        if profiling_conf.start and not self.start_configured:
+            self.profiler.start()
+        self.start_configured = profiling_conf.start
+
+    def _handle_signal(self, signum, frame):
+        if self.profiler:
+            self.profiler.start()
+        else:
+            logger.info('Received SIGUSR2, but profiling is not enabled in configuration')
@@ -0,0 +1,230 @@
+from datetime import datetime
+import json
+import logging
+from socket import getfqdn
+import threading
+from time import monotonic as monotime
+from time import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+default_report_timeout = 10
+default_pool_size = 10
+fqdn_cache_ttl = 600
+
+
+class ReportSender:
+    '''
+    Posts reports to Overwatch Hub.
+
+    One instance (and so one HTTP session with its connection pool) can be
+    shared by multiple agents and threads. The session (and the requests
+    library) is loaded only when first needed.
+    '''
+
+    def __init__(self, report_timeout=default_report_timeout):
+        self.report_timeout = report_timeout
+        self._session = None
+        self.session_lock = threading.Lock()
+        self.pool_size = default_pool_size
+        self.stats_lock = threading.Lock()
+        # agent name (from report label) -> SendStats
+        self.stats = {}
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self.session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        import requests
+        session = requests.session()
+        if self.pool_size > default_pool_size:
+            self._mount_adapters(session)
+        return session
+
+    def _mount_adapters(self, session):
+        from requests.adapters import HTTPAdapter
+        for prefix in 'http://', 'https://':
+            session.mount(prefix, HTTPAdapter(pool_maxsize=self.pool_size))
+
+    def set_pool_size(self, pool_size):
+        '''
+        Makes the connection pool large enough for pool_size threads using
+        the session concurrently, so that connections are not discarded.
+        '''
+        with self.session_lock:
+            if pool_size <= self.pool_size:
+                return
+            self.pool_size = pool_size
+            if self._session is not None:
+                self._mount_adapters(self._session)
+
+    def send(self, conf, report_data):
+        t0 = monotime()
+        error = None
+        try:
+            r = self.session.post(
+                conf.report_url,
+                data=encode_report(report_data),
+                headers={
+                    'Authorization': 'token ' + conf.report_token,
+                    'Content-Type': 'application/json',
+                },
+                timeout=self.report_timeout)
+            logger.debug('Report response: %s', r.text[:100])
+            r.raise_for_status()
+        except Exception as e:
+            logger.error('Failed to post report to %r: %r', conf.report_url, e)
+            logger.info('Report token: %s...%s', conf.report_token[:3], conf.report_token[-3:])
+            logger.info('Report data: %r', report_data)
+            error = e
+        agent = (report_data.get('label') or {}).get('agent')
+        with self.stats_lock:
+            stats = self.stats.get(agent)
+            if stats is None:
+                stats = self.stats[agent] = SendStats()
+            stats.send_count += 1
+            stats.last_duration = monotime() - t0
+            if error:
+                stats.failure_count += 1
+                stats.last_error = str(error)
+
+    def get_stats(self, agent=None):
+        '''
+        Returns report fragment with statistics of the reports sent so far
+        by the given agent (the sender may be shared by multiple agents),
+        or of all reports if agent is None.
+        '''
+        with self.stats_lock:
+            if agent is not None:
+                stats = self.stats.get(agent) or SendStats()
+            else:
+                stats = SendStats()
+                for st in self.stats.values():
+                    stats.send_count += st.send_count
+                    stats.failure_count += st.failure_count
+                    if st.last_duration is not None:
+                        stats.last_duration = st.last_duration
+                    stats.last_error = st.last_error or stats.last_error
+            return {
+                'count': value(stats.send_count, counter=True),
+                'failures': value(stats.failure_count, counter=True),
+                'last_duration': value(stats.last_duration, unit='seconds'),
+                'last_error': stats.last_error,
+            }
+
+
+class SendStats:
+
+    def __init__(self):
+        self.send_count = 0
+        self.failure_count = 0
+        self.last_duration = None
+        self.last_error = None
+
+
+def value(value, counter=None, unit=None, check_state=None):
+    '''
+    Helper function to generate the report value metadata fragment.
+    '''
+    data = {
+        '__value': value,
+    }
+    if counter:
+        data['__counter'] = True
+    if unit:
+        data['__unit'] = unit
+    if check_state:
+        data.setdefault('__check', {})
+        data['__check']['state'] = check_state
+    return data
+
+
+def encode_report(report_data):
+    '''
+    Serializes report to JSON bytes. Uses orjson if it is installed
+    (pip install overwatch-basic-agents[fast]), otherwise the stdlib json.
+    '''
+    if orjson is not None:
+        try:
+            return orjson.dumps(report_data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError as e:
+            # for example strings with lone surrogates (paths that are not valid UTF-8)
+            logger.debug('orjson failed to serialize report, using json: %r', e)
+    # ensure_ascii escapes surrogates as well, so the result is always valid UTF-8
+    return json.dumps(report_data, separators=(',', ':')).encode()
+
+
+_date_prefix_cache = (None, None)
+
+
+def format_date(timestamp=None):
+    '''
+    Returns UTC date like '2017-11-22T12:34:56.123456Z'.
+
+    Same as datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+    but strftime is called only when the second changes.
+    '''
+    global _date_prefix_cache
+    if timestamp is None:
+        timestamp = time()
+    seconds, microseconds = divmod(int(round(timestamp * 1e6)), 1000000)
+    cached_seconds, prefix = _date_prefix_cache
+    if cached_seconds != seconds:
+        prefix = datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%dT%H:%M:%S.')
+        _date_prefix_cache = (seconds, prefix)
+    return '{}{:06d}Z'.format(prefix, microseconds)
+
+
+_fqdn_cache = (None, None)
+
+
+def get_fqdn():
+    '''
+    Cached socket.getfqdn(), which may do a DNS lookup.
+    '''
+    global _fqdn_cache
+    expire, fqdn = _fqdn_cache
+    if expire is None or monotime() > expire:
+        fqdn = getfqdn()
+        _fqdn_cache = (monotime() + fqdn_cache_ttl, fqdn)
+    return fqdn
+
+
+_report_labels = {}
+
+
+def get_report_label(agent, target=None):
+    '''
+    Returns report label dict. The same dict object is returned for the same
+    arguments (as long as the hostname does not change), so it must not be
+    modified.
+    '''
+    host = get_fqdn()
+    key = (agent, target)
+    label = _report_labels.get(key)
+    if label is None or label['host'] != host:
+        label = {'agent': agent, 'host': host}
+        if target is not None:
+            label['target'] = target
+        _report_labels[key] = label
+    return label
+
+
+def add_watchdog(report_state, conf, sleep_interval):
+    wd_interval = conf.watchdog_interval or sleep_interval + 30
+    report_state['watchdog'] = {
+        '__watchdog': {
+            'deadline': int((time() + wd_interval) * 1000),
+        },
+    }
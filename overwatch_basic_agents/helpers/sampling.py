@@ -0,0 +1,46 @@
+from array import array
+from math import ceil
+
+
+class SampleBuffer:
+    '''
+    Fixed-size ring buffer of float samples.
+
+    When more samples than capacity are appended before the buffer is cleared
+    the oldest ones are overwritten, so memory usage stays constant.
+    '''
+
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.values = array('d', bytes(8 * capacity))
+        self.capacity = capacity
+        self.pos = 0
+        self.count = 0
+
+    def append(self, v):
+        self.values[self.pos] = v
+        self.pos = (self.pos + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        self.pos = 0
+        self.count = 0
+
+    def summary(self):
+        '''
+        Returns dict with min, max, avg and p95 of the buffered samples,
+        or None if there are no samples.
+        '''
+        if not self.count:
+            return None
+        if self.count < self.capacity:
+            values = sorted(self.values[:self.count])
+        else:
+            values = sorted(self.values)
+        n = len(values)
+        return {
+            'min': values[0],
+            'max': values[-1],
+            'avg': sum(values) / n,
+            'p95': values[max(ceil(0.95 * n) - 1, 0)],
+        }
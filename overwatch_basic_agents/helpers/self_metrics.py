@@ -0,0 +1,58 @@
+import logging
+import os
+import threading
+
+from .reporting import value
+
+
+logger = logging.getLogger(__name__)
+
+
+def gather_self_metrics(sender=None, agent=None, phase_durations=None, queue_depths=None):
+    '''
+    Returns report fragment describing the resource usage of the agent
+    process itself.
+
+    Parameter phase_durations is a dict phase name -> seconds, queue_depths
+    is a dict queue name -> number of items. Report send statistics are
+    those of the given agent only.
+    '''
+    data = {}
+    data['rss_bytes'] = value(_get_rss_bytes(), unit='bytes')
+    t = os.times()
+    data['cpu_time'] = {
+        'user': value(t.user, unit='seconds', counter=True),
+        'system': value(t.system, unit='seconds', counter=True),
+    }
+    data['open_fds'] = _get_open_fd_count()
+    data['threads'] = threading.active_count()
+    if queue_depths:
+        data['queue_depths'] = dict(queue_depths)
+    if phase_durations:
+        data['phase_durations'] = {k: value(v, unit='seconds') for k, v in phase_durations.items()}
+    if sender:
+        data['report_send'] = sender.get_stats(agent)
+    return data
+
+
+def _get_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # peak RSS only, in kilobytes on Linux and in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except Exception:
+        return None
+
+
+def _get_open_fd_count():
+    for fd_dir in '/proc/self/fd', '/dev/fd':
+        try:
+            return len(os.listdir(fd_dir))
+        except OSError:
+            pass
+    return None
@@ -1,25 +1,32 @@
 import argparse
-from collections import deque
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
 from itertools import count
 import logging
 import os
+from random import randrange
 import re
 from reprlib import repr as smart_repr
-import requests
-from socket import getfqdn
+import sys
 from time import monotonic as monotime
 from time import sleep, time
 
-from .helpers import BaseConfiguration, setup_logging, setup_log_file
+from .helpers import BaseConfiguration, ConfigurationWatcher, ProfilerHook, ReportSender, add_watchdog, format_date, gather_self_metrics, get_report_label, reuse_unchanged, setup_logging, setup_log_file, value
 
 
 logger = logging.getLogger(__name__)
 
 default_sleep_interval = 10
 default_report_timeout = 10
-
-rs = requests.session()
+default_scan_workers = 1
+default_scan_chunk_size = 4 * 2**20
+default_file_time_budget = 5
+max_line_length = 2**20
+default_error_lines_max_entries = 10
+default_error_line_max_length = 1000
+default_error_lines_max_bytes = 16 * 2**10
+default_error_lines_sample_window = 3600
 
 
 def log_agent_main():
@@ -47,11 +54,47 @@ class Configuration (BaseConfiguration):
         if not isinstance(data['log_files'], list):
             raise Exception('Configuration item overwatch_web_agent.watch must be a list')
         self.log_files = [LogFile(d, base_path) for d in data['log_files']]
+        self.scan = Scan(data.get('scan'))
+        self.error_lines = ErrorLineRetention(data.get('error_lines'))
+
+
+class Scan:
+
+    def __init__(self, data):
+        data = data or {}
+        # number of files scanned concurrently
+        self.workers = int(data.get('workers') or default_scan_workers)
+        # match regexes in worker processes, so that scanning is not limited by GIL
+        self.process_pool = bool(data.get('process_pool'))
+        if self.process_pool and sys.version_info < (3, 7):
+            # ProcessPoolExecutor does not accept mp_context before Python 3.7
+            raise Exception('Configuration item overwatch_log_agent.scan.process_pool requires Python 3.7 or newer')
+        self.chunk_size = int(data.get('chunk_size') or default_scan_chunk_size)
+        # how long can one file be scanned in one iteration; the rest is scanned in the next one
+        self.file_time_budget = float(data.get('file_time_budget') or default_file_time_budget)
+
+    def pool_params(self):
+        return (self.workers, self.process_pool)
+
+
+class ErrorLineRetention:
+
+    def __init__(self, data):
+        data = data or {}
+        # max. number of distinct error messages kept per file
+        self.max_entries = int(data.get('max_entries') or default_error_lines_max_entries)
+        # longer lines are truncated (characters)
+        self.max_line_length = int(data.get('max_line_length') or default_error_line_max_length)
+        # max. size of kept error lines per file
+        self.max_bytes = int(data.get('max_bytes') or default_error_lines_max_bytes)
+        # new messages compete for the kept slots with messages seen in this time window (seconds)
+        self.sample_window = float(data.get('sample_window') or default_error_lines_sample_window)
 
 
 class LogFile:
 
     def __init__(self, data, base_path):
+        self.data = data
         self.path = base_path / data['path']
         self.name = data.get('name')
         self.error_patterns = [Pattern(d) for d in data['error_patterns']]
@@ -60,99 +103,389 @@ class LogFile:
 class Pattern:
 
     def __init__(self, data):
+        self.data = data
         self.regex_str = data.get('regex')
         self.regex = re.compile(self.regex_str) if self.regex_str else None
 
 
 def run_log_agent(conf):
-    wfs = [WatchedFile(lf) for lf in conf.log_files]
-    sleep_interval = conf.sleep_interval or default_sleep_interval
+    agent = LogAgent(conf, ReportSender(report_timeout=default_report_timeout))
+    watcher = ConfigurationWatcher(conf.conf_file_path)
+    watcher.install_signal_handler()
+    profiler_hook = ProfilerHook()
+    profiler_hook.configure(conf.profiling)
     while True:
+        agent.run_iteration()
+        sleep(agent.sleep_interval)
+        new_conf = watcher.load_if_changed(Configuration)
+        if new_conf:
+            agent.reload(new_conf)
+            profiler_hook.configure(new_conf.profiling)
+
+
+class LogAgent:
+
+    name = 'log'
+
+    def __init__(self, conf, sender):
+        self.conf = conf
+        self.sender = sender
+        self.sleep_interval = conf.sleep_interval or default_sleep_interval
+        self.wfs = [WatchedFile(lf, conf.error_lines) for lf in conf.log_files]
+        self.thread_pool = None
+        self.process_pool = None
+        self._create_pools()
+
+    def _create_pools(self):
+        if self.conf.scan.workers > 1:
+            self.thread_pool = ThreadPoolExecutor(max_workers=self.conf.scan.workers)
+        if self.conf.scan.process_pool:
+            self.process_pool = create_process_pool(self.conf.scan.workers)
+
+    def _shutdown_pools(self):
+        for pool in self.thread_pool, self.process_pool:
+            if pool:
+                pool.shutdown(wait=True)
+        self.thread_pool = None
+        self.process_pool = None
+
+    def reload(self, conf):
+        conf.log_files = reuse_unchanged(self.conf.log_files, conf.log_files)
+        old_patterns = [ep for lf in self.conf.log_files for ep in lf.error_patterns]
+        wfs_by_path = {}
+        for wf in self.wfs:
+            wfs_by_path.setdefault(wf.wf_conf.path, []).append(wf)
+        new_wfs = []
+        for lf in conf.log_files:
+            # reuse compiled regexes
+            lf.error_patterns = reuse_unchanged(old_patterns, lf.error_patterns)
+            same_path = wfs_by_path.get(lf.path)
+            if same_path:
+                # keep the file offset and error lines, even if patterns have changed
+                wf = same_path.pop(0)
+                wf.wf_conf = lf
+                wf.error_lines.configure(conf.error_lines)
+            else:
+                wf = WatchedFile(lf, conf.error_lines)
+            new_wfs.append(wf)
+        for unmatched in wfs_by_path.values():
+            for wf in unmatched:
+                wf.close()
+        pools_changed = conf.scan.pool_params() != self.conf.scan.pool_params()
+        if pools_changed:
+            self._shutdown_pools()
+        self.conf = conf
+        self.sleep_interval = conf.sleep_interval or default_sleep_interval
+        self.wfs = new_wfs
+        if pools_changed:
+            self._create_pools()
+
+    def run_iteration(self):
         t0 = monotime()
         report = {
-            'label': {
-                'agent': 'log',
-                'host': getfqdn(),
-            },
-            'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'label': get_report_label('log'),
+            'date': format_date(),
             'state': {
-                'configuration_file': str(conf.conf_file_path),
+                'configuration_file': str(self.conf.conf_file_path),
                 'log_files': {},
             },
         }
-        for wf in wfs:
-            wf.run(timestamp=time())
+        scan_kwargs = {
+            'time_budget': self.conf.scan.file_time_budget,
+            'chunk_size': self.conf.scan.chunk_size,
+            'process_pool': self.process_pool,
+        }
+        if self.thread_pool:
+            futures = [self.thread_pool.submit(wf.run, timestamp=time(), **scan_kwargs) for wf in self.wfs]
+            for f in futures:
+                f.result()
+        else:
+            for wf in self.wfs:
+                wf.run(timestamp=time(), **scan_kwargs)
+        t1 = monotime()
+        for wf in self.wfs:
             wf.add_to_report(report['state'])
-        finish_and_send_report(report, conf, sleep_interval, t0)
-        sleep(sleep_interval)
-
-
-def finish_and_send_report(report_data, conf, sleep_interval, t0):
-    # add watchdog
-    wd_interval = conf.watchdog_interval or sleep_interval + 30
-    report_data['state']['watchdog'] = {
-        '__watchdog': {
-            'deadline': int((time() + wd_interval) * 1000),
-        },
-    }
-    report_data['state']['iteration_duration_s'] = monotime() - t0
+        phase_durations = {'scan': t1 - t0, 'report': monotime() - t1}
+        report['state']['self_metrics'] = gather_self_metrics(sender=self.sender, agent='log', phase_durations=phase_durations)
+        finish_and_send_report(report, self.conf, self.sleep_interval, t0, self.sender)
+
+
+def create_process_pool(workers):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    # do not fork, the agent may be running other threads (for example in the multi-agent runner)
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+
+def find_error_lines(data, regexes):
+    '''
+    Returns lines (str, without trailing whitespace) of data (bytes with
+    whole lines) that match any of the regexes.
+    '''
     try:
-        r = rs.post(
-            conf.report_url,
-            json=report_data,
-            headers={'Authorization': 'token ' + conf.report_token},
-            timeout=default_report_timeout)
-        logger.debug('Report response: %s', r.text[:100])
-        r.raise_for_status()
-    except Exception as e:
-        logger.error('Failed to post report to %r: %r', conf.report_url, e)
-        logger.info('Report token: %s...%s', conf.report_token[:3], conf.report_token[-3:])
-        logger.info('Report data: %r', report_data)
+        lines = data.decode().split('\n')
+    except ValueError:
+        lines = [decode_line(line) for line in data.split(b'\n')]
+    if lines and lines[-1] == '':
+        lines.pop()
+    searches = [regex.search for regex in regexes]
+    result = []
+    for line in lines:
+        line = line.rstrip()
+        for search in searches:
+            if search(line):
+                result.append(line)
+                break
+    return result
+
+
+def decode_line(line_bytes):
+    try:
+        return line_bytes.decode()
+    except ValueError as e:
+        logger.warning('Failed to decode line %s: %r', smart_repr(line_bytes), e)
+        return str(line_bytes)
+
+
+_worker_regexes = {}
+
+
+def find_error_lines_in_worker(data, regex_strs):
+    '''
+    Same as find_error_lines, but to be called in process pool worker;
+    compiled regexes are cached in the worker process.
+    '''
+    regexes = _worker_regexes.get(regex_strs)
+    if regexes is None:
+        regexes = _worker_regexes[regex_strs] = [re.compile(r) for r in regex_strs]
+    return find_error_lines(data, regexes)
+
+
+def finish_and_send_report(report_data, conf, sleep_interval, t0, sender):
+    add_watchdog(report_data['state'], conf, sleep_interval)
+    report_data['state']['iteration_duration_s'] = monotime() - t0
+    sender.send(conf, report_data)
+
+
+class ErrorLine:
+
+    # rough per-entry overhead of the report fragment
+    overhead_bytes = 200
+
+    def __init__(self, fingerprint, line, line_length, timestamp, key):
+        self.fingerprint = fingerprint
+        self.line = line
+        self.line_length = line_length
+        self.key = key
+        self.count = 1
+        self.first_seen = timestamp
+        self.first_date = format_date(timestamp)
+        self.last_seen = timestamp
+        self.size = len(line.encode(errors='replace')) + self.overhead_bytes
+
+    def report(self):
+        return {
+            'date': format_date(self.last_seen),
+            'first_date': self.first_date,
+            'count': self.count,
+            'line': self.line,
+            'line_length': self.line_length,
+            'fingerprint': self.fingerprint.hex(),
+        }
+
+
+_variable_part_re = re.compile(r'0x[0-9a-f]+|[0-9a-f]{8,}|\d+', re.I)
+
+
+def line_fingerprint(line):
+    '''
+    Lines differing only in numbers (dates, ids, durations...) have the same fingerprint.
+    '''
+    normalized = _variable_part_re.sub('#', line)
+    return blake2b(normalized.encode(errors='replace'), digest_size=8).digest()
+
+
+class ErrorLines:
+    '''
+    Sample of distinct error lines of one file, kept within a fixed budget.
+
+    Repeated messages (same fingerprint) are only counted. When there are
+    more distinct messages than the budget allows, reservoir sampling decides
+    which of them are kept, so that one repeated or huge message does not
+    push out everything else. Fingerprints of dropped messages are
+    remembered (within sample_window, as many as fit into max_bytes), so
+    that a repeat of a dropped message does not compete for a slot again.
+    '''
+
+    # rough memory used by one remembered fingerprint of a dropped message
+    dropped_fingerprint_bytes = 100
+
+    def __init__(self, retention):
+        self.retention = retention
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.last_timestamp = None
+        self.window_start = None
+        self.distinct_seen = 0
+        # LRU of fingerprints of dropped messages
+        self.dropped = OrderedDict()
+        # distinct messages dropped
+        self.dropped_count = 0
+        # occurrences of dropped messages
+        self.dropped_lines = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def configure(self, retention):
+        self.retention = retention
+        self._enforce_budget()
+
+    def add(self, line, timestamp, key):
+        self.last_timestamp = timestamp if self.last_timestamp is None else max(self.last_timestamp, timestamp)
+        line_length = len(line)
+        if line_length > self.retention.max_line_length:
+            line = line[:self.retention.max_line_length]
+        fingerprint = line_fingerprint(line)
+        entry = self.entries.get(fingerprint)
+        if entry:
+            entry.count += 1
+            entry.last_seen = max(entry.last_seen, timestamp)
+            return
+        if self.window_start is None or timestamp - self.window_start >= self.retention.sample_window:
+            self.window_start = timestamp
+            self.distinct_seen = len(self.entries)
+            self.dropped.clear()
+        if fingerprint in self.dropped:
+            self.dropped.move_to_end(fingerprint)
+            self.dropped_lines += 1
+            return
+        self.distinct_seen += 1
+        entry = ErrorLine(fingerprint, line, line_length, timestamp, key)
+        full = len(self.entries) >= self.retention.max_entries
+        if full or self.total_bytes + entry.size > self.retention.max_bytes:
+            # keep the new message with probability (kept entries / distinct messages seen)
+            n = randrange(self.distinct_seen)
+            if n >= len(self.entries):
+                self._add_dropped(fingerprint)
+                self.dropped_lines += 1
+                return
+            self._remove(list(self.entries)[n])
+        self.entries[fingerprint] = entry
+        self.total_bytes += entry.size
+        self._enforce_budget(keep=fingerprint)
+
+    def _enforce_budget(self, keep=None):
+        while len(self.entries) > 1:
+            if len(self.entries) <= self.retention.max_entries and self.total_bytes <= self.retention.max_bytes:
+                break
+            candidates = [fp for fp in self.entries if fp != keep]
+            self._remove(candidates[randrange(len(candidates))])
+
+    def _remove(self, fingerprint):
+        self.total_bytes -= self.entries.pop(fingerprint).size
+        self._add_dropped(fingerprint)
+
+    def _add_dropped(self, fingerprint):
+        self.dropped_count += 1
+        self.dropped[fingerprint] = None
+        max_dropped = max(self.retention.max_bytes // self.dropped_fingerprint_bytes, self.retention.max_entries)
+        while len(self.dropped) > max_dropped:
+            self.dropped.popitem(last=False)
 
 
 class WatchedFile:
 
-    def __init__(self, wf_conf):
+    def __init__(self, wf_conf, error_line_retention=None):
         self.wf_conf = wf_conf
         self.f = None
         self.stat = None
-        self.error_lines = deque(maxlen=10)
+        self.error_lines = ErrorLines(error_line_retention or ErrorLineRetention(None))
         self.line_counter = count()
+        self.last_scan_duration = None
+        self.backlog_bytes = 0
+
+    def run(self, timestamp, time_budget=None, chunk_size=default_scan_chunk_size, process_pool=None):
+        '''
+        Reads new lines of the file. If time_budget (seconds) runs out, the
+        rest of the file is left for the next run.
+        '''
+        t0 = monotime()
+        deadline = t0 + time_budget if time_budget else None
+        self._run(timestamp, deadline, chunk_size, process_pool)
+        self.last_scan_duration = monotime() - t0
 
-    def run(self, timestamp):
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def _run(self, timestamp, deadline, chunk_size, process_pool):
         if self.f is None:
             logger.debug('Opening file %s', self.wf_conf.path)
             self.full_path = self.wf_conf.path.resolve()
             self.f = self.full_path.open('rb')
             self.stat = os.stat(self.f.fileno())
+        at_eof = False
         while True:
-            line = self.f.readline()
-            if line == b'':
+            if deadline and monotime() > deadline:
+                break
+            data = self.f.read(chunk_size)
+            if not data:
+                at_eof = True
+                break
+            rest = b''
+            if not data.endswith(b'\n'):
+                # read the rest of the last line
+                rest = self.f.readline(max_line_length)
+                data += rest
+            if not data.endswith(b'\n') and len(rest) < max_line_length:
+                # leave the incomplete line at the end of the file for the next run
+                end = data.rfind(b'\n') + 1
+                self.f.seek(end - len(data), os.SEEK_CUR)
+                data = data[:end]
+                at_eof = True
+            if data:
+                self.process_chunk(data, timestamp, process_pool)
+            if at_eof:
                 break
-            self.process_line(line, timestamp)
         current_stat = os.stat(self.f.fileno())
-        same_file = all((
-            self.stat.st_ino == current_stat.st_ino,
-            self.stat.st_dev == current_stat.st_dev,
+        self.backlog_bytes = max(current_stat.st_size - self.f.tell(), 0)
+        try:
+            path_stat = os.stat(str(self.full_path))
+        except FileNotFoundError:
+            path_stat = None
+        rotated = path_stat is not None and not all((
+            self.stat.st_ino == path_stat.st_ino,
+            self.stat.st_dev == path_stat.st_dev,
         ))
-        if not same_file:
+        if rotated and at_eof:
+            # a new file is at the path and we have read all of the old one
+            rest = self.f.read()
+            if rest:
+                self.process_chunk(rest, timestamp, process_pool)
             logger.debug('Closing file %s', self.full_path)
+            self.f.close()
             self.f = None
             self.stat = None
 
-    def process_line(self, line_bytes, timestamp):
-        try:
-            line = line_bytes.decode().rstrip()
-        except ValueError as e:
-            logger.warning('Failed to decode line %s: %r', smart_repr(line_bytes), e)
-            line = str(line_bytes)
-        is_error = False
-        for ep in self.wf_conf.error_patterns:
-            if ep.regex and ep.regex.search(line):
-                is_error = True
-        if is_error:
-            n = next(self.line_counter)
-            self.error_lines.append((timestamp, n, line))
+    def process_chunk(self, data, timestamp, process_pool=None):
+        regexes = [ep.regex for ep in self.wf_conf.error_patterns if ep.regex]
+        if process_pool:
+            regex_strs = tuple(r.pattern for r in regexes)
+            lines = process_pool.submit(find_error_lines_in_worker, data, regex_strs).result()
+        else:
+            lines = find_error_lines(data, regexes)
+        for line in lines:
+            self.add_error_line(line, timestamp)
+
+    def add_error_line(self, line, timestamp):
+        n = next(self.line_counter)
+        self.error_lines.add(line, timestamp, key='{}:{}'.format(timestamp, n))
 
     def add_to_report(self, report_state):
         real_name = str(self.wf_conf.name or self.full_path)
@@ -160,21 +493,25 @@ class WatchedFile:
             'path': str(self.full_path),
             'size_bytes': self.stat.st_size,
             'inode': '{}:{}'.format(self.stat.st_dev, self.stat.st_ino),
+            'scan_duration_s': self.last_scan_duration,
+            'backlog_bytes': value(self.backlog_bytes, unit='bytes'),
             'last_error_lines': {},
+            'error_lines_retention': {
+                'retained': len(self.error_lines),
+                'retained_bytes': value(self.error_lines.total_bytes, unit='bytes'),
+                'dropped': value(self.error_lines.dropped_count, counter=True),
+                'dropped_lines': value(self.error_lines.dropped_lines, counter=True),
+            },
             'last_error_date': {
                 '__value': None,
                 '__check': {'state': 'green'},
             },
         }
-        for timestamp, n, line in self.error_lines:
-            k = '{}:{}'.format(timestamp, n)
-            wf_state['last_error_lines'][k] = {
-                'date': datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-                'line': line,
-            }
-        if self.error_lines:
-            last_error_ts = max(ts for ts, n, line in self.error_lines)
-            wf_state['last_error_date']['__value'] = datetime.utcfromtimestamp(last_error_ts).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        for entry in self.error_lines:
+            wf_state['last_error_lines'][entry.key] = entry.report()
+        if self.error_lines.last_timestamp is not None:
+            last_error_ts = self.error_lines.last_timestamp
+            wf_state['last_error_date']['__value'] = format_date(last_error_ts)
             last_error_dt = time() - last_error_ts
             if last_error_dt < 10 * 60:
                 wf_state['last_error_date']['__check']['state'] = 'red'
@@ -0,0 +1,160 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappop, heappush
+import logging
+import threading
+from time import monotonic as monotime
+
+from .helpers import ConfigurationWatcher, ProfilerHook, ReportSender, load_configuration_file, setup_logging, setup_log_file
+
+
+logger = logging.getLogger(__name__)
+
+default_report_timeout = 10
+default_reload_check_interval = 5
+
+
+def multi_agent_main():
+    p = argparse.ArgumentParser(
+        description='Run all agents configured in the configuration file in a single process')
+    p.add_argument('--verbose', '-v', action='count')
+    p.add_argument('conf_file')
+    args = p.parse_args()
+    try:
+        setup_logging(verbosity=args.verbose)
+        sender = ReportSender(report_timeout=default_report_timeout)
+        agents = create_agents(args.conf_file, sender)
+        if not agents:
+            raise Exception('No agent configured in {}'.format(args.conf_file))
+        for log_file_path in sorted(set(a.conf.log.file_path for a in agents if a.conf.log.file_path)):
+            setup_log_file(log_file_path)
+        logger.debug('Multi agent starting with agents: %s', ', '.join(a.name for a in agents))
+        watcher = ConfigurationWatcher(args.conf_file)
+        watcher.install_signal_handler()
+        profiler_hook = ProfilerHook()
+        profiler_hook.configure(agents[0].conf.profiling)
+        Scheduler(agents, watcher=watcher, profiler_hook=profiler_hook).run()
+    except BaseException as e:
+        logger.exception('Multi agent failed: %r', e)
+        raise e
+
+
+def get_agent_classes():
+    '''
+    Returns list of tuples (Configuration class, Agent class)
+    '''
+    from . import log_agent, system_agent, web_agent
+    return [
+        (system_agent.Configuration, system_agent.SystemAgent),
+        (web_agent.Configuration, web_agent.WebAgent),
+        (log_agent.Configuration, log_agent.LogAgent),
+    ]
+
+
+def load_configurations(conf_file_path):
+    '''
+    Loads the configuration file once and returns list of tuples
+    (configuration, Agent class) for each top-level section that is present
+    in it. Raises exception if any of the sections is not valid.
+    '''
+    data = load_configuration_file(conf_file_path)
+    confs = []
+    for conf_class, agent_class in get_agent_classes():
+        if data.get(conf_class.top_level_key):
+            confs.append((conf_class(conf_file_path, data=data), agent_class))
+    return confs
+
+
+def create_agents(conf_file_path, sender):
+    return [agent_class(conf, sender) for conf, agent_class in load_configurations(conf_file_path)]
+
+
+class Scheduler:
+    '''
+    Runs iterations of multiple agents, each with its own sleep interval.
+
+    Every agent iteration runs in a worker thread, so a slow agent does not
+    delay the others, and an exception in one iteration is logged without
+    affecting the other agents. The next iteration of an agent is scheduled
+    sleep_interval seconds after the previous one has finished (the same as
+    when the agent runs standalone).
+
+    If watcher (ConfigurationWatcher) is given, the configuration is reloaded
+    when it changes; the new configuration is passed to the agents before
+    their next iteration.
+    '''
+
+    def __init__(self, agents, watcher=None, reload_check_interval=default_reload_check_interval, profiler_hook=None):
+        self.agents = agents
+        self.watcher = watcher
+        self.profiler_hook = profiler_hook
+        self.reload_check_interval = reload_check_interval
+        self.next_reload_check = monotime() + reload_check_interval
+        self.pending_confs = {}
+        self.executor = ThreadPoolExecutor(max_workers=len(agents))
+        self.queue = []
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.iteration_counts = [0] * len(agents)
+        self.failure_counts = [0] * len(agents)
+
+    def run(self):
+        with self.cond:
+            for n in range(len(self.agents)):
+                heappush(self.queue, (monotime(), n))
+            while not self.stopped:
+                now = monotime()
+                if self.watcher and now >= self.next_reload_check:
+                    self._check_reload()
+                    self.next_reload_check = now + self.reload_check_interval
+                if self.queue and self.queue[0][0] <= now:
+                    next_time, n = heappop(self.queue)
+                    self.executor.submit(self._run_agent_iteration, n)
+                    continue
+                timeout = self.queue[0][0] - now if self.queue else None
+                if self.watcher:
+                    timeout = min(timeout or self.reload_check_interval, self.next_reload_check - now)
+                self.cond.wait(timeout)
+        self.executor.shutdown(wait=True)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def _check_reload(self):
+        if not self.watcher.check():
+            return
+        try:
+            confs = load_configurations(self.watcher.conf_file_path)
+        except Exception as e:
+            logger.error('Failed to load configuration %s, keeping the current one: %r', self.watcher.conf_file_path, e)
+            return
+        if self.profiler_hook and confs:
+            self.profiler_hook.configure(confs[0][0].profiling)
+        confs_by_key = {conf.top_level_key: conf for conf, agent_class in confs}
+        for n, agent in enumerate(self.agents):
+            conf = confs_by_key.pop(agent.conf.top_level_key, None)
+            if conf is None:
+                logger.warning('Section %s was removed from configuration; restart to stop %s agent', agent.conf.top_level_key, agent.name)
+            else:
+                self.pending_confs[n] = conf
+        for key in confs_by_key:
+            logger.warning('Section %s was added to configuration; restart to start its agent', key)
+
+    def _run_agent_iteration(self, n):
+        agent = self.agents[n]
+        with self.cond:
+            new_conf = self.pending_confs.pop(n, None)
+        try:
+            if new_conf:
+                logger.info('Reloading configuration of %s agent', agent.name)
+                agent.reload(new_conf)
+            agent.run_iteration()
+        except Exception as e:
+            logger.exception('%s agent iteration failed: %r', agent.name, e)
+            self.failure_counts[n] += 1
+        self.iteration_counts[n] += 1
+        with self.cond:
+            heappush(self.queue, (monotime() + agent.sleep_interval, n))
+            self.cond.notify()
@@ -1,24 +1,35 @@
 import argparse
+from bisect import bisect_left
 from collections import OrderedDict
-from datetime import datetime
 from datetime import timedelta
 import logging
+from math import ceil
 import os
+from pathlib import Path
 import psutil
-import requests
-from socket import getfqdn
+import threading
 from time import monotonic as monotime
-from time import time, sleep
+from time import sleep
 
-from .helpers import BaseConfiguration, setup_logging, setup_log_file
+from .helpers import BaseConfiguration, ConfigurationWatcher, ProfilerHook, ReportSender, SampleBuffer, add_watchdog, format_date, gather_self_metrics, get_report_label, setup_logging, setup_log_file, value
 
 
 logger = logging.getLogger(__name__)
 
 default_sleep_interval = 15
 default_report_timeout = 10
+default_top_processes = 10
+default_process_scan_time_limit = 0.5
+default_cgroup_root = '/sys/fs/cgroup'
+default_pressure_red_thresholds = {
+    # percentage of time (avg60) some tasks were stalled on the resource
+    'cpu': 80,
+    'memory': 20,
+    'io': 40,
+}
+default_cgroup_memory_percent_red_threshold = 90
 
-rs = requests.session()
+_session = None
 
 
 def system_agent_main():
@@ -43,85 +54,153 @@ class Configuration (BaseConfiguration):
 
     def _load(self, data, base_path):
         super()._load(data, base_path)
+        self.processes = Processes(data.get('processes'))
+        self.pressure = Pressure(data.get('pressure'))
+        if not isinstance(data.get('cgroups') or [], list):
+            raise Exception('Configuration item overwatch_system_agent.cgroups must be a list')
+        self.cgroups = [CGroup(d) for d in data.get('cgroups') or []]
+        self.sampling = Sampling(data.get('sampling'))
 
 
-def run_system_agent(conf):
-    sleep_interval = conf.sleep_interval or default_sleep_interval
-    while True:
-        run_system_agent_iteration(conf, sleep_interval)
-        sleep(sleep_interval)
+class Processes:
+
+    def __init__(self, data):
+        data = data or {}
+        self.top_n = int(data.get('top_n') or default_top_processes)
+        self.scan_time_limit = float(data.get('scan_time_limit') or default_process_scan_time_limit)
+
+
+class Sampling:
+
+    def __init__(self, data):
+        data = data or {}
+        # high-resolution sampling is disabled unless interval is configured
+        self.interval = float(data['interval']) if data.get('interval') else None
+
+
+class Pressure:
+
+    def __init__(self, data):
+        data = data or {}
+        self.red_thresholds = dict(default_pressure_red_thresholds)
+        for resource in self.red_thresholds:
+            if data.get(resource + '_red_threshold') is not None:
+                self.red_thresholds[resource] = float(data[resource + '_red_threshold'])
+
+
+class CGroup:
 
+    def __init__(self, data, cgroup_root=default_cgroup_root):
+        self.path = Path(cgroup_root) / data['path']
+        self.name = data.get('name')
+        self.memory_percent_red_threshold = float(
+            data.get('memory_percent_red_threshold') or default_cgroup_memory_percent_red_threshold)
 
-def run_system_agent_iteration(conf, sleep_interval):
-    report_date = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-    report_label = OrderedDict()
-    report_label['agent'] = 'system'
-    report_label['host'] = getfqdn()
+
+def run_system_agent(conf):
+    agent = SystemAgent(conf, ReportSender(report_timeout=default_report_timeout))
+    watcher = ConfigurationWatcher(conf.conf_file_path)
+    watcher.install_signal_handler()
+    profiler_hook = ProfilerHook()
+    profiler_hook.configure(conf.profiling)
+    while True:
+        agent.run_iteration()
+        sleep(agent.sleep_interval)
+        new_conf = watcher.load_if_changed(Configuration)
+        if new_conf:
+            agent.reload(new_conf)
+            profiler_hook.configure(new_conf.profiling)
+
+
+class SystemAgent:
+
+    name = 'system'
+
+    def __init__(self, conf, sender):
+        self.conf = conf
+        self.sender = sender
+        self.sleep_interval = conf.sleep_interval or default_sleep_interval
+        self.sampler = None
+        self._start_sampler()
+
+    def _start_sampler(self):
+        if self.conf.sampling.interval:
+            self.sampler = Sampler(self.conf.sampling.interval, window=self.sleep_interval)
+            self.sampler.start()
+
+    def reload(self, conf):
+        old_sleep_interval = self.sleep_interval
+        old_sampling_interval = self.conf.sampling.interval
+        self.conf = conf
+        self.sleep_interval = conf.sleep_interval or default_sleep_interval
+        if (old_sleep_interval, old_sampling_interval) != (self.sleep_interval, conf.sampling.interval):
+            if self.sampler:
+                self.sampler.stop()
+                self.sampler = None
+            self._start_sampler()
+
+    def run_iteration(self):
+        run_system_agent_iteration(self.conf, self.sleep_interval, self.sender, sampler=self.sampler)
+
+
+def run_system_agent_iteration(conf, sleep_interval, sender, sampler=None):
+    report_date = format_date()
     t0 = monotime()
-    report_state = gather_state(conf)
+    phase_durations = OrderedDict()
+    report_state = gather_state(conf, phase_durations=phase_durations)
     duration = monotime() - t0
     report_state['duration'] = duration
-
-    # add watchdog
-    wd_interval = conf.watchdog_interval or sleep_interval + 30
-    report_state['watchdog'] = {
-        '__watchdog': {
-            'deadline': int((time() + wd_interval) * 1000),
-        },
-    }
-
+    if sampler:
+        report_state['samples'] = sampler.collect()
+    report_state['self_metrics'] = gather_self_metrics(sender=sender, agent='system', phase_durations=phase_durations)
+    add_watchdog(report_state, conf, sleep_interval)
     report_data = {
-        'label': report_label,
+        'label': get_report_label('system'),
         'date': report_date,
         'state': report_state,
     }
+    sender.send(conf, report_data)
 
-    try:
-        r = rs.post(conf.report_url,
-            json=report_data,
-            headers={'Authorization': 'token ' + conf.report_token},
-            timeout=default_report_timeout)
-        logger.debug('Report response: %s', r.text[:100])
-        r.raise_for_status()
-    except Exception as e:
-        logger.error('Failed to post report to %r: %r', conf.report_url, e)
-        logger.info('Report token: %s...%s', conf.report_token[:3], conf.report_token[-3:])
-        logger.info('Report data: %r', report_data)
 
-
-def gather_state(conf):
+def gather_state(conf, phase_durations=None):
+    '''
+    Parameter phase_durations, if given, is filled with durations of the
+    individual collectors.
+    '''
+    collectors = [
+        ('cpu', gather_cpu),
+        ('load', gather_load),
+        ('uptime', gather_uptime),
+        ('volumes', gather_volumes),
+        ('memory', gather_memory),
+        ('swap', gather_swap),
+        ('processes', lambda: gather_processes(conf.processes if conf else Processes(None))),
+        ('pressure', lambda: gather_pressure(conf.pressure if conf else Pressure(None))),
+    ]
+    if conf and conf.cgroups:
+        collectors.append(('cgroups', lambda: gather_cgroups(conf.cgroups, conf.pressure)))
+    collectors.append(('outward_ip4', gather_outward_ip4))
+    collectors.append(('outward_ip6', gather_outward_ip6))
     state = OrderedDict()
-    state['cpu'] = gather_cpu()
-    state['load'] = gather_load()
-    state['uptime'] = gather_uptime()
-    state['volumes'] = gather_volumes()
-    state['memory'] = gather_memory()
-    state['swap'] = gather_swap()
-    state['outward_ip4'] = gather_outward_ip4()
-    state['outward_ip6'] = gather_outward_ip6()
+    for name, collector in collectors:
+        t0 = monotime()
+        state[name] = collector()
+        if phase_durations is not None:
+            phase_durations[name] = monotime() - t0
     return state
 
 
-def value(value, counter=None, unit=None, check_state=None):
-    '''
-    Helper function to generate the report value metadata fragment.
-    '''
-    data = {
-        '__value': value,
-    }
-    if counter:
-        data['__counter'] = True
-    if unit:
-        data['__unit'] = unit
-    if check_state:
-        data.setdefault('__check', {})
-        data['__check']['state'] = check_state
-    return data
+def get_session():
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.session()
+    return _session
 
 
 def gather_outward_ip4():
     try:
-        r = rs.get('https://ip4.messa.cz/', timeout=10)
+        r = get_session().get('https://ip4.messa.cz/', timeout=10)
         r.raise_for_status()
         return r.text.strip()
     except Exception as e:
@@ -131,7 +210,7 @@ def gather_outward_ip4():
 
 def gather_outward_ip6():
     try:
-        r = rs.get('https://ip6.messa.cz/', timeout=10)
+        r = get_session().get('https://ip6.messa.cz/', timeout=10)
         r.raise_for_status()
         return r.text.strip()
     except Exception as e:
@@ -162,13 +241,29 @@ def gather_uptime():
     return data
 
 
+_cpu_count = None
+
+
+def get_cpu_count():
+    '''
+    CPU count does not change (hotplug aside) and psutil has to parse
+    /proc/cpuinfo to get the physical count, so it is computed only once.
+    The returned dict is shared between reports.
+    '''
+    global _cpu_count
+    if _cpu_count is None:
+        count = OrderedDict()
+        count['logical'] = psutil.cpu_count(logical=True)
+        count['physical'] = psutil.cpu_count(logical=False)
+        _cpu_count = count
+    return _cpu_count
+
+
 def gather_cpu():
     ct = psutil.cpu_times()
     cs = psutil.cpu_stats()
     data = OrderedDict()
-    data['count'] = OrderedDict()
-    data['count']['logical'] = psutil.cpu_count(logical=True)
-    data['count']['physical'] = psutil.cpu_count(logical=False)
+    data['count'] = get_cpu_count()
     data['times'] = OrderedDict()
     data['stats'] = OrderedDict()
     data['stats']['ctx_switches'] = value(cs.ctx_switches, counter=True)
@@ -223,3 +318,323 @@ def gather_swap():
     data['free_bytes'] = value(sw.free, unit='bytes')
     data['percent'] = value(sw.percent, check_state='red' if sw.percent > 80 else 'green')
     return data
+
+
+class ProcessScanner:
+    '''
+    Reads /proc/<pid>/stat directly (much cheaper than psutil.process_iter)
+    and remembers CPU ticks of every process between scans, so that CPU usage
+    can be computed as a delta.
+    '''
+
+    def __init__(self, proc_path='/proc'):
+        self.proc_path = proc_path
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        # (pid, starttime) -> (cpu ticks, monotime)
+        self.prev_ticks = {}
+        # where to continue after a scan was cut short by the time limit
+        self.resume_pid = 0
+
+    def scan(self, time_limit):
+        '''
+        Returns tuple (processes, total_count, truncated); processes is a list
+        of tuples (pid, name, cpu_percent or None, rss_bytes).
+        '''
+        deadline = monotime() + time_limit
+        pids = sorted(int(name) for name in os.listdir(self.proc_path) if name.isdigit())
+        i = bisect_left(pids, self.resume_pid)
+        pids = pids[i:] + pids[:i]
+        processes = []
+        current_ticks = {}
+        truncated = False
+        for n, pid in enumerate(pids):
+            if monotime() > deadline:
+                truncated = True
+                self.resume_pid = pid
+                # keep the state of processes we did not get to this time
+                unscanned = set(pids[n:])
+                for key, v in self.prev_ticks.items():
+                    if key[0] in unscanned:
+                        current_ticks[key] = v
+                break
+            try:
+                name, ticks, starttime, rss_pages = self._read_stat(pid)
+            except (OSError, ValueError, IndexError):
+                # process has probably exited meanwhile
+                continue
+            t = monotime()
+            key = (pid, starttime)
+            cpu_percent = None
+            prev = self.prev_ticks.get(key)
+            if prev and t > prev[1]:
+                cpu_percent = 100 * (ticks - prev[0]) / self.clock_ticks / (t - prev[1])
+            current_ticks[key] = (ticks, t)
+            processes.append((pid, name, cpu_percent, rss_pages * self.page_size))
+        else:
+            self.resume_pid = 0
+        self.prev_ticks = current_ticks
+        return processes, len(pids), truncated
+
+    def _read_stat(self, pid):
+        with open('{}/{}/stat'.format(self.proc_path, pid), 'rb') as f:
+            data = f.read()
+        # process name is in parentheses and may contain spaces or parentheses
+        lpar = data.index(b'(')
+        rpar = data.rindex(b')')
+        name = data[lpar+1:rpar].decode(errors='replace')
+        fields = data[rpar+2:].split()
+        # see proc(5); fields[0] is field no. 3 (state)
+        ticks = int(fields[11]) + int(fields[12])
+        return name, ticks, int(fields[19]), int(fields[21])
+
+    def read_cmdline(self, pid, max_length=200):
+        try:
+            with open('{}/{}/cmdline'.format(self.proc_path, pid), 'rb') as f:
+                data = f.read(max_length * 4)
+        except OSError:
+            return None
+        return data.replace(b'\0', b' ').decode(errors='replace').strip()[:max_length]
+
+
+process_scanner = None
+
+
+def gather_processes(proc_conf, scanner=None):
+    global process_scanner
+    if scanner is None:
+        if process_scanner is None:
+            if not os.path.isdir('/proc'):
+                logger.debug('Cannot gather processes: /proc not available')
+                return None
+            process_scanner = ProcessScanner()
+        scanner = process_scanner
+    t0 = monotime()
+    processes, total_count, truncated = scanner.scan(time_limit=proc_conf.scan_time_limit)
+    duration = monotime() - t0
+    if truncated:
+        logger.info('Process scan truncated after %d of %d processes', len(processes), total_count)
+
+    def process_data(pid, name, cpu_percent, rss_bytes):
+        p_data = OrderedDict()
+        p_data['pid'] = pid
+        p_data['name'] = name
+        p_data['cmdline'] = scanner.read_cmdline(pid)
+        p_data['cpu_percent'] = value(round(cpu_percent, 1) if cpu_percent is not None else None, unit='percents')
+        p_data['rss_bytes'] = value(rss_bytes, unit='bytes')
+        return p_data
+
+    top_cpu = sorted((p for p in processes if p[2] is not None), key=lambda p: p[2], reverse=True)
+    top_rss = sorted(processes, key=lambda p: p[3], reverse=True)
+    data = OrderedDict()
+    data['count'] = total_count
+    data['scanned_count'] = len(processes)
+    data['scan_truncated'] = truncated
+    data['scan_duration'] = value(duration, unit='seconds')
+    data['top_cpu'] = OrderedDict(
+        ('{:02d}'.format(n), process_data(*p)) for n, p in enumerate(top_cpu[:proc_conf.top_n], start=1))
+    data['top_rss'] = OrderedDict(
+        ('{:02d}'.format(n), process_data(*p)) for n, p in enumerate(top_rss[:proc_conf.top_n], start=1))
+    return data
+
+
+def gather_pressure(pressure_conf, pressure_path='/proc/pressure'):
+    '''
+    Pressure stall information (PSI), available since Linux 4.20
+    '''
+    if not os.path.isdir(pressure_path):
+        logger.debug('Cannot gather pressure: %s not available', pressure_path)
+        return None
+    data = OrderedDict()
+    for resource in 'cpu', 'memory', 'io':
+        try:
+            data[resource] = read_pressure_file(
+                os.path.join(pressure_path, resource),
+                red_threshold=pressure_conf.red_thresholds[resource])
+        except OSError as e:
+            logger.debug('Cannot read %s pressure: %r', resource, e)
+    return data
+
+
+def read_pressure_file(path, red_threshold):
+    '''
+    Parses PSI file with lines like "some avg10=1.45 avg60=1.44 avg300=0.76 total=3556996"
+    '''
+    data = OrderedDict()
+    with open(path) as f:
+        for line in f:
+            kind, *items = line.split()
+            items = dict(item.split('=', 1) for item in items)
+            avg60 = float(items['avg60'])
+            k_data = data[kind] = OrderedDict()
+            k_data['avg10'] = value(float(items['avg10']), unit='percents')
+            k_data['avg60'] = value(avg60, unit='percents', check_state='red' if avg60 >= red_threshold else 'green')
+            k_data['avg300'] = value(float(items['avg300']), unit='percents')
+            k_data['total'] = value(int(items['total']) / 1e6, unit='seconds', counter=True)
+    return data
+
+
+def gather_cgroups(cgroups, pressure_conf):
+    data = OrderedDict()
+    for cg in cgroups:
+        data[cg.name or str(cg.path)] = gather_cgroup(cg, pressure_conf)
+    return data
+
+
+def gather_cgroup(cg, pressure_conf):
+    '''
+    Gathers cgroup v2 resource usage from cpu.stat, memory.current and io.stat
+    '''
+    data = OrderedDict()
+    data['path'] = str(cg.path)
+    if not cg.path.is_dir():
+        data['error'] = value('cgroup {} does not exist'.format(cg.path), check_state='red')
+        return data
+    data['error'] = value(None, check_state='green')
+
+    try:
+        data['cpu'] = cpu_data = OrderedDict()
+        for line in (cg.path / 'cpu.stat').read_text().splitlines():
+            k, v = line.split()
+            if k.endswith('_usec'):
+                cpu_data[k[:-5]] = value(int(v) / 1e6, unit='seconds', counter=True)
+            else:
+                cpu_data[k] = value(int(v), counter=True)
+    except OSError as e:
+        logger.debug('Cannot read cpu.stat of cgroup %s: %r', cg.path, e)
+
+    try:
+        current = int((cg.path / 'memory.current').read_text())
+    except OSError as e:
+        logger.debug('Cannot read memory.current of cgroup %s: %r', cg.path, e)
+    else:
+        data['memory'] = mem_data = OrderedDict()
+        mem_data['current_bytes'] = value(current, unit='bytes')
+        try:
+            limit = (cg.path / 'memory.max').read_text().strip()
+        except OSError:
+            limit = 'max'
+        if limit != 'max':
+            percent = round(100 * current / int(limit), 2) if int(limit) else 100
+            percent_state = 'red' if percent >= cg.memory_percent_red_threshold else 'green'
+            mem_data['max_bytes'] = value(int(limit), unit='bytes')
+            mem_data['percent'] = value(percent, unit='percents', check_state=percent_state)
+
+    try:
+        io_lines = (cg.path / 'io.stat').read_text().splitlines()
+    except OSError as e:
+        logger.debug('Cannot read io.stat of cgroup %s: %r', cg.path, e)
+    else:
+        data['io'] = io_data = OrderedDict()
+        for line in io_lines:
+            device, *items = line.split()
+            io_data[device] = dev_data = OrderedDict()
+            for item in items:
+                k, v = item.split('=', 1)
+                if k.endswith('bytes'):
+                    dev_data[k] = value(int(v), unit='bytes', counter=True)
+                else:
+                    dev_data[k] = value(int(v), counter=True)
+
+    pressure = OrderedDict()
+    for resource in 'cpu', 'memory', 'io':
+        try:
+            pressure[resource] = read_pressure_file(
+                str(cg.path / (resource + '.pressure')),
+                red_threshold=pressure_conf.red_thresholds[resource])
+        except OSError:
+            pass
+    if pressure:
+        data['pressure'] = pressure
+    return data
+
+
+class Sampler:
+    '''
+    Samples cheap metrics (CPU, memory, PSI) in a background thread at a
+    higher frequency than the report interval, so that short spikes are not
+    missed. Each report carries min/max/avg/p95 over the samples taken since
+    the previous report.
+    '''
+
+    def __init__(self, interval, window, pressure_path='/proc/pressure'):
+        self.interval = interval
+        self.pressure_path = pressure_path
+        # room for two report intervals in case a report gets delayed
+        capacity = max(ceil(2 * window / interval), 1)
+        self.buffers = OrderedDict()
+        self.buffers['cpu_percent'] = SampleBuffer(capacity)
+        self.buffers['memory_available_bytes'] = SampleBuffer(capacity)
+        self.pressure_resources = []
+        for resource in 'cpu', 'memory', 'io':
+            if os.path.exists(os.path.join(pressure_path, resource)):
+                self.pressure_resources.append(resource)
+                self.buffers[resource + '_pressure_percent'] = SampleBuffer(capacity)
+        self.prev_pressure_totals = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        assert self.thread is None
+        psutil.cpu_percent(interval=None)
+        self.thread = threading.Thread(target=self._run, name='Sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        next_time = monotime() + self.interval
+        while not self.stop_event.wait(max(next_time - monotime(), 0)):
+            next_time += self.interval
+            if next_time < monotime():
+                # we are late (system suspended or overloaded), do not try to catch up
+                next_time = monotime() + self.interval
+            try:
+                self.sample()
+            except Exception as e:
+                logger.exception('Sampling failed: %r', e)
+
+    def sample(self):
+        samples = {
+            'cpu_percent': psutil.cpu_percent(interval=None),
+            'memory_available_bytes': psutil.virtual_memory().available,
+        }
+        t = monotime()
+        for resource in self.pressure_resources:
+            # compute stall percentage since the previous sample from the "some" total
+            with open(os.path.join(self.pressure_path, resource)) as f:
+                total = int(f.readline().rsplit('total=', 1)[1])
+            prev = self.prev_pressure_totals.get(resource)
+            if prev and t > prev[1]:
+                samples[resource + '_pressure_percent'] = 100 * (total - prev[0]) / 1e6 / (t - prev[1])
+            self.prev_pressure_totals[resource] = (total, t)
+        with self.lock:
+            for k, v in samples.items():
+                self.buffers[k].append(v)
+
+    def collect(self):
+        '''
+        Returns summary of samples gathered since the last call and clears them.
+        '''
+        units = {
+            'cpu_percent': 'percents',
+            'memory_available_bytes': 'bytes',
+        }
+        data = OrderedDict()
+        data['interval'] = value(self.interval, unit='seconds')
+        with self.lock:
+            data['count'] = self.buffers['cpu_percent'].count
+            for k, buf in self.buffers.items():
+                summary = buf.summary()
+                buf.clear()
+                if summary is None:
+                    continue
+                unit = units.get(k, 'percents')
+                data[k] = OrderedDict()
+                for stat in 'min', 'max', 'avg', 'p95':
+                    data[k][stat] = value(summary[stat], unit=unit)
+        return data
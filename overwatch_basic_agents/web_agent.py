@@ -1,15 +1,15 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from multiprocessing import Process
+from itertools import count
 import logging
-import requests
-from socket import AF_INET, getfqdn, socket
+from socket import AF_INET, create_connection, socket
 import ssl
 from time import monotonic as monotime
-from time import sleep, time
+from time import sleep
 from urllib.parse import urlparse
 
-from .helpers import BaseConfiguration, setup_logging, setup_log_file
+from .helpers import BaseConfiguration, ConfigurationWatcher, ProfilerHook, ReportSender, add_watchdog, format_date, gather_self_metrics, get_report_label, reuse_unchanged, SampleBuffer, setup_logging, setup_log_file
 
 
 logger = logging.getLogger(__name__)
@@ -18,6 +18,16 @@ default_sleep_interval = 30
 default_timeout = 10
 default_report_timeout = 10
 default_user_agent = 'Overwatch Web Agent'
+default_workers = 20
+request_modes = ('get', 'conditional', 'head')
+default_min_timeout = 1
+default_latency_multiplier = 4
+default_down_after_failures = 3
+default_probe_timeout = 1
+default_probe_budget = 10
+default_max_backoff = 600
+latency_samples = 20
+min_latency_samples = 5
 
 
 def web_agent_main():
@@ -45,71 +55,264 @@ class Configuration (BaseConfiguration):
         if not isinstance(data['watch'], list):
             raise Exception('Configuration item overwatch_web_agent.watch must be a list')
         self.watch_targets = [Target(d) for d in data['watch']]
+        self.workers = int(data.get('workers') or default_workers)
+        self.backoff = Backoff(data.get('backoff'))
+
+
+class Backoff:
+
+    def __init__(self, data):
+        data = data or {}
+        # request timeout is derived from recent latency of the target, within these limits
+        self.timeout = float(data.get('timeout') or default_timeout)
+        self.min_timeout = float(data.get('min_timeout') or default_min_timeout)
+        self.latency_multiplier = float(data.get('latency_multiplier') or default_latency_multiplier)
+        # target is considered down after this many consecutive failed checks;
+        # then it is checked less often and only after a successful TCP connect probe
+        self.down_after_failures = int(data.get('down_after_failures') or default_down_after_failures)
+        self.probe_timeout = float(data.get('probe_timeout') or default_probe_timeout)
+        # how many down targets can be probed in one iteration
+        self.probe_budget = int(data.get('probe_budget') or default_probe_budget)
+        self.max_backoff = float(data.get('max_backoff') or default_max_backoff)
 
 
 class Target:
 
     def __init__(self, data):
+        self.data = data
         self.name = data.get('name')
         self.url = data['url']
         self.response_contains = data.get('response_contains')
+        # get - always download the whole response
+        # conditional - send If-None-Match/If-Modified-Since; on 304 reuse the last result
+        # head - HEAD request, the body is not checked
+        self.request_mode = data.get('request_mode') or 'get'
+        if self.request_mode not in request_modes:
+            raise Exception('Target {}: request_mode must be one of {}'.format(self.url, ', '.join(request_modes)))
+        if self.request_mode == 'head' and self.response_contains:
+            raise Exception('Target {}: request_mode head cannot be used with response_contains'.format(self.url))
+        # result of the last downloaded response, used in conditional mode
+        self.cached_response = None
+        self.health = TargetHealth()
+
+
+class TargetHealth:
+
+    def __init__(self):
+        self.latencies = SampleBuffer(latency_samples)
+        self.consecutive_failures = 0
+        self.last_error = None
+        # monotime when a down target should be checked again
+        self.next_check = 0
+
+    def is_down(self, backoff):
+        return self.consecutive_failures >= backoff.down_after_failures
+
+    def timeout(self, backoff):
+        if self.latencies.count < min_latency_samples:
+            return backoff.timeout
+        p95 = self.latencies.summary()['p95']
+        return min(max(p95 * backoff.latency_multiplier, backoff.min_timeout), backoff.timeout)
+
+    def record_success(self, duration):
+        self.latencies.append(duration)
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.next_check = 0
+
+    def record_failure(self, error, backoff, sleep_interval):
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.is_down(backoff):
+            exponent = min(self.consecutive_failures - backoff.down_after_failures, 16)
+            self.next_check = monotime() + min(sleep_interval * 2 ** exponent, backoff.max_backoff)
+
+
+class CachedResponse:
+
+    def __init__(self, r, response_contains_present, verified_date):
+        self.etag = r.headers.get('ETag')
+        self.last_modified = r.headers.get('Last-Modified')
+        self.status_code = r.status_code
+        self.content_length = len(r.content)
+        self.response_contains_present = response_contains_present
+        self.verified_date = verified_date
 
 
 def run_web_agent(conf):
-    sleep_interval = conf.sleep_interval or default_sleep_interval
+    agent = WebAgent(conf, ReportSender(report_timeout=default_report_timeout))
+    watcher = ConfigurationWatcher(conf.conf_file_path)
+    watcher.install_signal_handler()
+    profiler_hook = ProfilerHook()
+    profiler_hook.configure(conf.profiling)
     while True:
-        run_web_agent_iteration(conf, sleep_interval)
-        sleep(sleep_interval)
+        agent.run_iteration()
+        sleep(agent.sleep_interval)
+        new_conf = watcher.load_if_changed(Configuration)
+        if new_conf:
+            agent.reload(new_conf)
+            profiler_hook.configure(new_conf.profiling)
+
 
+class WebAgent:
 
-def run_web_agent_iteration(conf, sleep_interval):
+    name = 'web'
+
+    def __init__(self, conf, sender):
+        self.conf = conf
+        self.sender = sender
+        self.sleep_interval = conf.sleep_interval or default_sleep_interval
+        self.executor = ThreadPoolExecutor(max_workers=conf.workers)
+        self.sender.set_pool_size(conf.workers)
+        # created in the first iteration, so that requests is imported only when needed
+        self.check_session = None
+
+    def reload(self, conf):
+        conf.watch_targets = reuse_unchanged(self.conf.watch_targets, conf.watch_targets)
+        if conf.workers != self.conf.workers:
+            self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(max_workers=conf.workers)
+            self.sender.set_pool_size(conf.workers)
+            if self.check_session:
+                self.check_session.close()
+                self.check_session = None
+        self.conf = conf
+        self.sleep_interval = conf.sleep_interval or default_sleep_interval
+
+    def run_iteration(self):
+        if self.check_session is None:
+            self.check_session = create_check_session(self.conf.workers)
+        run_web_agent_iteration(self.conf, self.sleep_interval, self.sender, self.executor, self.check_session)
+
+
+def create_check_session(pool_size):
+    '''
+    Returns HTTP session for checking targets, separate from the session
+    used for posting reports. All cookies are rejected, so that no check
+    reuses a session (login) cookie set by a target in a previous check.
+    '''
+    from http.cookiejar import DefaultCookiePolicy
+    import requests
+    from requests.adapters import HTTPAdapter
     rs = requests.session()
-    procs = []
-    for n, target in enumerate(conf.watch_targets, start=1):
-        logger.info('Processing target %d/%d: %s', n, len(conf.watch_targets), target.url)
-        p = Process(target=process_target, args=(conf, sleep_interval, rs, target, ))
-        p.start()
-        procs.append(p)
-       #process_target(conf, sleep_interval, rs, target)
-#    for p in procs:
-#        p.join()
-
-
-def process_target(conf, sleep_interval, rs, target):
+    rs.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    for prefix in 'http://', 'https://':
+        rs.mount(prefix, HTTPAdapter(pool_maxsize=pool_size))
+    return rs
+
+
+def run_web_agent_iteration(conf, sleep_interval, sender, executor, rs):
+    targets = conf.watch_targets
+    started = count(1)
+    probed = select_probed_targets(targets, conf.backoff)
+
+    def run(n, target):
+        logger.info('Processing target %d/%d: %s', n, len(targets), target.url)
+        queue_depths = {'pending_targets': len(targets) - next(started)}
+        process_target(conf, sleep_interval, sender, rs, target, queue_depths=queue_depths, probe=target in probed)
+
+    futures = [executor.submit(run, n, target) for n, target in enumerate(targets, start=1)]
+    wait(futures)
+    for f in futures:
+        if f.exception():
+            logger.error('Failed to process target: %r', f.exception())
+
+
+def select_probed_targets(targets, backoff):
+    '''
+    Returns down targets that are due to be checked in this iteration,
+    at most backoff.probe_budget of them, the longest waiting first.
+    '''
+    now = monotime()
+    due = [t for t in targets if t.health.is_down(backoff) and t.health.next_check <= now]
+    due.sort(key=lambda t: t.health.next_check)
+    return due[:backoff.probe_budget]
+
+
+def process_target(conf, sleep_interval, sender, rs, target, queue_depths=None, probe=False):
     report_data = {
-        'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-        'label': {
-            'agent': 'web',
-            'host': getfqdn(),
-            'target': target.name or target.url,
-        },
+        'date': format_date(),
+        'label': get_report_label('web', target=target.name or target.url),
         'state': {},
     }
-    check_target(rs, target, report_data['state'])
+    t0 = monotime()
+    check_target_with_backoff(rs, target, report_data['state'], conf.backoff, sleep_interval, probe=probe)
+    report_data['state']['self_metrics'] = gather_self_metrics(
+        sender=sender,
+        agent='web',
+        phase_durations={'check': monotime() - t0},
+        queue_depths=queue_depths)
+    add_watchdog(report_data['state'], conf, sleep_interval)
+    sender.send(conf, report_data)
+
 
-    # add watchdog
-    wd_interval = conf.watchdog_interval or sleep_interval + 30
-    report_data['state']['watchdog'] = {
-        '__watchdog': {'deadline': int((time() + wd_interval) * 1000)},
+def check_target_with_backoff(rs, target, report_state, backoff, sleep_interval, probe=False):
+    '''
+    Healthy targets are checked every time. Down targets are checked only
+    when selected for probe (see select_probed_targets), and the full
+    check is made only if TCP connect to the target succeeds.
+    '''
+    health = target.health
+    if health.is_down(backoff) and not probe:
+        report_state['name'] = target.name
+        report_state['url'] = target.url
+        report_state['error'] = {
+            '__value': 'Not checked (target is down): {}'.format(health.last_error),
+            '__check': {'state': 'red'},
+        }
+        mode = 'deferred'
+    elif probe and not probe_connect(target.url, backoff.probe_timeout, report_state):
+        report_state['name'] = target.name
+        report_state['url'] = target.url
+        report_state['error'] = {
+            '__value': report_state['probe']['error'],
+            '__check': {'state': 'red'},
+        }
+        health.record_failure(report_state['probe']['error'], backoff, sleep_interval)
+        mode = 'probe'
+    else:
+        timeout = health.timeout(backoff)
+        check_target(rs, target, report_state, timeout=timeout)
+        if report_state['error']['__value'] is not None and timeout < backoff.timeout:
+            # the shorter timeout only speeds up the check of a healthy target;
+            # a target that is just slower than usual must not be reported as failed
+            logger.info('Retrying %s with full timeout: %s', target.url, report_state['error']['__value'])
+            report_state['short_timeout_error'] = report_state['error']['__value']
+            timeout = backoff.timeout
+            check_target(rs, target, report_state, timeout=timeout)
+        report_state['timeout_seconds'] = timeout
+        error = report_state['error']['__value']
+        if error is None:
+            health.record_success(report_state['duration_seconds'])
+        else:
+            health.record_failure(error, backoff, sleep_interval)
+        mode = 'full'
+    report_state['availability'] = {
+        'check': mode,
+        'consecutive_failures': health.consecutive_failures,
+        'next_check_in_s': max(health.next_check - monotime(), 0) if health.is_down(backoff) else None,
     }
 
+
+def probe_connect(url, timeout, report_state):
+    '''
+    Cheap check whether anything listens on the target host and port.
+    '''
+    p = urlparse(url)
+    port = p.port or (443 if p.scheme == 'https' else 80)
+    t0 = monotime()
     try:
-        r = rs.post(
-            conf.report_url,
-            json=report_data,
-            headers={'Authorization': 'token ' + conf.report_token},
-            timeout=default_report_timeout)
-        logger.debug('Report response: %s', r.text[:100])
-        r.raise_for_status()
+        create_connection((p.hostname, port), timeout=timeout).close()
     except Exception as e:
-        logger.error('Failed to post report to %r: %r', conf.report_url, e)
-        logger.info('Report token: %s...%s', conf.report_token[:3], conf.report_token[-3:])
-        logger.info('Report data: %r', report_data)
+        report_state['probe'] = {'duration_seconds': monotime() - t0, 'error': 'TCP probe failed: {}'.format(e)}
+        return False
+    report_state['probe'] = {'duration_seconds': monotime() - t0, 'error': None}
+    return True
 
 
 def check_target(rs, target, report_state, timeout=None):
     '''
-    parameter timeout is used in tests
+    Parameter timeout (seconds) defaults to default_timeout.
     '''
     report_state['name'] = target.name
     report_state['url'] = target.url
@@ -124,7 +327,7 @@ def check_target(rs, target, report_state, timeout=None):
             t0 = monotime()
             cx = ssl.create_default_context()
             conn = cx.wrap_socket(socket(AF_INET), server_hostname=hostname)
-            conn.settimeout(5)
+            conn.settimeout(min(timeout or 5, 5))
             conn.connect((p.hostname, port or 443))
             try:
                 cert = conn.getpeercert()
@@ -160,13 +363,26 @@ def check_target(rs, target, report_state, timeout=None):
             }
 
     # make HTTP request
+    # plain objects without these attributes are used as targets in tests
+    request_mode = getattr(target, 'request_mode', 'get')
+    cached = getattr(target, 'cached_response', None) if request_mode == 'conditional' else None
+    headers = {
+        'User-Agent': default_user_agent,
+    }
+    if cached:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
     t1 = monotime()
     try:
         try:
-            r = rs.get(target.url,
-                headers={
-                    'User-Agent': default_user_agent,
-                },
+            r = rs.request(
+                'HEAD' if request_mode == 'head' else 'GET',
+                target.url,
+                headers=headers,
+                allow_redirects=True,
                 timeout=timeout or default_timeout)
         finally:
             duration = monotime() - t1
@@ -184,18 +400,47 @@ def check_target(rs, target, report_state, timeout=None):
         '__check': {'state': 'green'},
     }
     report_state['final_url'] = r.url
+
+    if cached and r.status_code == 304:
+        # content has not changed since it was last downloaded and verified
+        status_code = cached.status_code
+        content_length = cached.content_length
+        present = cached.response_contains_present
+        validation = 'revalidated'
+        verified_date = cached.verified_date
+    else:
+        status_code = r.status_code
+        if request_mode == 'head':
+            content_length = _int_or_none(r.headers.get('Content-Length'))
+            present = None
+            validation = 'head'
+            verified_date = None
+        else:
+            content_length = len(r.content)
+            present = target.response_contains in r.text if target.response_contains else None
+            validation = 'downloaded'
+            verified_date = format_date()
+            if request_mode == 'conditional':
+                has_validators = r.headers.get('ETag') or r.headers.get('Last-Modified')
+                target.cached_response = CachedResponse(r, present, verified_date) if r.status_code == 200 and has_validators else None
+
     report_state['response'] = {
         'status_code': {
-            '__value': r.status_code,
+            '__value': status_code,
             '__check': {
-                'state': 'green' if r.status_code == 200 else 'red',
+                'state': 'green' if status_code == 200 else 'red',
             },
         },
-        'content_length': len(r.content),
+        'content_length': content_length,
+        # downloaded - the body was downloaded (and checked)
+        # revalidated - server responded 304 Not Modified, result of the last download is used
+        # head - HEAD request, the body was not downloaded
+        'validation': validation,
+        'content_verified_date': verified_date,
+        'transferred_bytes': _transferred_bytes(r),
     }
 
     if target.response_contains:
-        present = target.response_contains in r.text
         report_state['response_contains'] = {
             'text': target.response_contains,
             'present': {
@@ -205,3 +450,22 @@ def check_target(rs, target, report_state, timeout=None):
                 },
             },
         }
+
+
+def _transferred_bytes(r):
+    '''
+    Returns number of body bytes received over the network (still
+    compressed, if Content-Encoding is used), or None if it is not known.
+    '''
+    r.content  # make sure the whole body has been read
+    if getattr(r.raw, 'chunked', False):
+        # urllib3 does not count bytes of chunked responses
+        return None if r.headers.get('Content-Encoding') else len(r.content)
+    return r.raw.tell()
+
+
+def _int_or_none(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
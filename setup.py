@@ -22,8 +22,13 @@ setup(
         'pyyaml',
         'psutil',
     ],
+    extras_require={
+        # faster report serialization
+        'fast': ['orjson'],
+    },
     entry_points={
         'console_scripts': [
+            'overwatch-agents=overwatch_basic_agents:multi_agent_main',
             'overwatch-log-agent=overwatch_basic_agents:log_agent_main',
             'overwatch-system-agent=overwatch_basic_agents:system_agent_main',
             'overwatch-web-agent=overwatch_basic_agents:web_agent_main',
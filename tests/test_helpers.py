@@ -0,0 +1,152 @@
+
+def test_sample_buffer():
+    from overwatch_basic_agents.helpers import SampleBuffer
+    buf = SampleBuffer(capacity=20)
+    assert buf.summary() is None
+    for n in range(1, 31):
+        buf.append(n)
+    # only the last 20 values (11..30) are kept
+    assert buf.summary() == {'min': 11, 'max': 30, 'avg': 20.5, 'p95': 29}
+    buf.clear()
+    buf.append(5)
+    assert buf.summary() == {'min': 5, 'max': 5, 'avg': 5, 'p95': 5}
+
+
+def test_configuration_watcher(temp_dir):
+    import os
+    import signal
+    from overwatch_basic_agents.helpers import ConfigurationWatcher
+    conf_path = temp_dir / 'conf.yaml'
+    conf_path.write_text('a: 1\n')
+    watcher = ConfigurationWatcher(conf_path)
+    assert not watcher.check()
+    conf_path.write_text('a: 22\n')
+    assert watcher.check()
+    assert not watcher.check()
+    old_handler = signal.getsignal(signal.SIGHUP)
+    try:
+        watcher.install_signal_handler()
+        os.kill(os.getpid(), signal.SIGHUP)
+    finally:
+        signal.signal(signal.SIGHUP, old_handler)
+    assert watcher.check()
+    assert not watcher.check()
+
+
+def test_reuse_unchanged():
+    from overwatch_basic_agents.helpers import reuse_unchanged
+    class Item:
+        def __init__(self, data):
+            self.data = data
+    old = [Item({'url': 'a'}), Item({'url': 'b'})]
+    new = [Item({'url': 'b'}), Item({'url': 'c'})]
+    result = reuse_unchanged(old, new)
+    assert result[0] is old[1]
+    assert result[1] is new[1]
+
+
+def test_gather_self_metrics():
+    from overwatch_basic_agents.helpers import ReportSender, gather_self_metrics
+
+    class conf:
+        report_url = 'http://localhost:4/report'
+        report_token = 'secret'
+
+    sender = ReportSender(report_timeout=0.1)
+    sender.send(conf, {'state': {}})
+    data = gather_self_metrics(sender=sender, phase_durations={'scan': 0.5}, queue_depths={'pending': 3})
+    assert data['rss_bytes']['__value'] > 0
+    assert data['open_fds'] > 0
+    assert data['threads'] >= 1
+    assert data['phase_durations']['scan'] == {'__value': 0.5, '__unit': 'seconds'}
+    assert data['queue_depths'] == {'pending': 3}
+    assert data['report_send']['count']['__value'] == 1
+    assert data['report_send']['failures']['__value'] == 1
+
+
+def test_report_send_stats_per_agent():
+    from overwatch_basic_agents.helpers import ReportSender, gather_self_metrics
+
+    class conf:
+        report_url = 'http://localhost:4/report'
+        report_token = 'secret'
+
+    sender = ReportSender(report_timeout=0.1)
+    sender.send(conf, {'label': {'agent': 'web'}, 'state': {}})
+    sender.send(conf, {'label': {'agent': 'web'}, 'state': {}})
+    sender.send(conf, {'label': {'agent': 'log'}, 'state': {}})
+    assert gather_self_metrics(sender=sender, agent='web')['report_send']['failures']['__value'] == 2
+    assert gather_self_metrics(sender=sender, agent='log')['report_send']['failures']['__value'] == 1
+    assert gather_self_metrics(sender=sender, agent='system')['report_send']['count']['__value'] == 0
+    assert sender.get_stats()['count']['__value'] == 3
+
+
+def test_sampling_profiler(temp_dir):
+    import threading
+    from overwatch_basic_agents.helpers import SamplingProfiler
+    stop = threading.Event()
+
+    def busy_function():
+        while not stop.is_set():
+            sum(range(1000))
+
+    t = threading.Thread(target=busy_function)
+    t.start()
+    try:
+        profiler = SamplingProfiler(output_dir=temp_dir, duration=0.1, interval=0.005)
+        path = profiler.write(profiler.sample())
+    finally:
+        stop.set()
+        t.join()
+    assert 'busy_function' in path.read_text()
+
+
+def test_profiler_hook_does_not_restart_on_reload(temp_dir):
+    import signal
+    from overwatch_basic_agents.helpers import ProfilerHook
+    from overwatch_basic_agents.helpers.configuration import _Profiling
+    conf = _Profiling({'enabled': True, 'start': True, 'duration': 0.5, 'interval': 0.01}, temp_dir)
+    hook = ProfilerHook()
+    try:
+        hook.configure(conf)
+        profiler = hook.profiler
+        thread = profiler.thread
+        assert profiler.is_running()
+        hook.configure(conf)
+        assert hook.profiler is profiler
+        assert profiler.thread is thread
+        thread.join()
+        # start is still on, but it was not turned on by this reload
+        hook.configure(conf)
+        assert not profiler.is_running()
+    finally:
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+    assert len(list(temp_dir.glob('overwatch-profile-*'))) == 1
+
+
+def test_format_date():
+    from datetime import datetime
+    from overwatch_basic_agents.helpers import format_date
+    for ts in 1511354096.0, 1511354096.123456, 1511354096.999999, 1511354097.5, 0:
+        assert format_date(ts) == datetime.utcfromtimestamp(ts).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    assert format_date().endswith('Z')
+
+
+def test_encode_report(monkeypatch):
+    from collections import OrderedDict
+    import json
+    from overwatch_basic_agents.helpers import reporting
+    report = {'label': {'agent': 'test'}, 'state': OrderedDict([('text', 'Příliš žluťoučký'), ('n', 1.5)])}
+    assert json.loads(reporting.encode_report(report).decode()) == report
+    monkeypatch.setattr(reporting, 'orjson', None)
+    assert json.loads(reporting.encode_report(report).decode()) == report
+
+
+def test_encode_report_with_surrogates(monkeypatch):
+    import json
+    from overwatch_basic_agents.helpers import reporting
+    # psutil returns such strings for mountpoints that are not valid UTF-8
+    report = {'state': {'volumes': {'/mnt/\udcff': 1}}}
+    assert json.loads(reporting.encode_report(report).decode()) == report
+    monkeypatch.setattr(reporting, 'orjson', None)
+    assert json.loads(reporting.encode_report(report).decode()) == report
@@ -0,0 +1,65 @@
+import json
+import subprocess
+import sys
+
+
+measure_script = '''
+import json, sys
+from time import monotonic
+
+def get_rss_kb():
+    with open('/proc/self/status') as f:
+        return int(f.read().split('VmRSS:')[1].split()[0])
+
+rss_before_kb = get_rss_kb()
+t0 = monotonic()
+import {module}
+duration = monotonic() - t0
+print(json.dumps({{
+    'duration': duration,
+    'rss_increase_kb': get_rss_kb() - rss_before_kb,
+    'modules': sorted(sys.modules),
+}}))
+'''
+
+heavy_modules = ['multiprocessing', 'psutil', 'requests', 'ssl', 'urllib3']
+
+
+def measure_import(module, project_dir):
+    out = subprocess.check_output(
+        [sys.executable, '-c', measure_script.format(module=module)],
+        cwd=str(project_dir))
+    result = json.loads(out.decode())
+    print('Import of {}: {:.3f} s, RSS +{} kB'.format(module, result['duration'], result['rss_increase_kb']))
+    return result
+
+
+def imported_heavy_modules(result):
+    return [m for m in heavy_modules if m in result['modules']]
+
+
+def test_import_package(project_dir):
+    result = measure_import('overwatch_basic_agents', project_dir)
+    assert imported_heavy_modules(result) == []
+
+
+def test_import_log_agent(project_dir):
+    result = measure_import('overwatch_basic_agents.log_agent', project_dir)
+    assert imported_heavy_modules(result) == []
+    # about 8 MB here; importing requests and psutil as well would add another 10 MB
+    assert result['rss_increase_kb'] < 14 * 1024
+
+
+def test_import_multi_agent(project_dir):
+    result = measure_import('overwatch_basic_agents.multi_agent', project_dir)
+    assert imported_heavy_modules(result) == []
+
+
+def test_import_system_agent(project_dir):
+    result = measure_import('overwatch_basic_agents.system_agent', project_dir)
+    assert imported_heavy_modules(result) == ['psutil']
+
+
+def test_import_web_agent(project_dir):
+    result = measure_import('overwatch_basic_agents.web_agent', project_dir)
+    assert imported_heavy_modules(result) == ['ssl']
@@ -2,3 +2,188 @@
 def test_load_sample_configuration(project_dir):
     from overwatch_basic_agents.log_agent import Configuration
     assert Configuration(project_dir / 'sample_configuration.yaml')
+
+
+class DummySender:
+
+    def __init__(self):
+        self.reports = []
+
+    def send(self, conf, report_data):
+        self.reports.append(report_data)
+
+    def get_stats(self, agent=None):
+        return {}
+
+
+def test_reload_keeps_watched_file_state(temp_dir):
+    from overwatch_basic_agents.log_agent import Configuration, LogAgent
+    (temp_dir / 'a.log').write_text('ERROR one\n')
+    (temp_dir / 'b.log').write_text('ERROR two\n')
+    conf_path = temp_dir / 'conf.yaml'
+    conf_path.write_text(
+        'overwatch_log_agent:\n'
+        '  report_url: http://localhost:4/report\n'
+        '  report_token: secret\n'
+        '  log_files:\n'
+        '    - path: a.log\n'
+        '      error_patterns: [{regex: ERROR}]\n')
+    sender = DummySender()
+    agent = LogAgent(Configuration(conf_path), sender)
+    agent.run_iteration()
+    wf_a = agent.wfs[0]
+    assert len(wf_a.error_lines) == 1
+    conf_path.write_text(
+        'overwatch_log_agent:\n'
+        '  report_url: http://localhost:4/report\n'
+        '  report_token: secret\n'
+        '  log_files:\n'
+        '    - path: a.log\n'
+        '      error_patterns: [{regex: ERROR}]\n'
+        '    - path: b.log\n'
+        '      error_patterns: [{regex: ERROR}]\n')
+    agent.reload(Configuration(conf_path))
+    assert agent.wfs[0] is wf_a
+    assert agent.wfs[0].wf_conf.error_patterns[0].regex is wf_a.wf_conf.error_patterns[0].regex
+    agent.run_iteration()
+    # the first file is not read again from the beginning
+    assert len(wf_a.error_lines) == 1
+    assert len(agent.wfs[1].error_lines) == 1
+    assert len(sender.reports[-1]['state']['log_files']) == 2
+    # removed file is closed
+    f_a = wf_a.f
+    conf_path.write_text(
+        'overwatch_log_agent:\n'
+        '  report_url: http://localhost:4/report\n'
+        '  report_token: secret\n'
+        '  log_files:\n'
+        '    - path: b.log\n'
+        '      error_patterns: [{regex: ERROR}]\n')
+    agent.reload(Configuration(conf_path))
+    assert len(agent.wfs) == 1
+    assert f_a.closed
+
+
+def watched_file(path, regex='ERROR'):
+    from overwatch_basic_agents.log_agent import LogFile, WatchedFile
+    return WatchedFile(LogFile({'path': path.name, 'error_patterns': [{'regex': regex}]}, path.parent))
+
+
+def test_watched_file_incomplete_line(temp_dir):
+    path = temp_dir / 'a.log'
+    path.write_bytes(b'ok\nERROR one\nERR')
+    wf = watched_file(path)
+    wf.run(timestamp=1, chunk_size=4)
+    assert [entry.line for entry in wf.error_lines] == ['ERROR one']
+    with path.open('ab') as f:
+        f.write(b'OR two \xff\n')
+    wf.run(timestamp=2, chunk_size=4)
+    assert [entry.line for entry in wf.error_lines] == ['ERROR one', "b'ERROR two \\xff'"]
+
+
+def test_watched_file_time_budget(temp_dir):
+    path = temp_dir / 'a.log'
+    path.write_bytes(b'ERROR line\n' * 1000)
+    wf = watched_file(path)
+    wf.run(timestamp=1, chunk_size=110, time_budget=-1)
+    assert wf.backlog_bytes == 11000
+    wf.run(timestamp=1, chunk_size=110)
+    assert wf.backlog_bytes == 0
+    assert next(wf.line_counter) == 1000
+
+
+def test_watched_file_rotation(temp_dir):
+    path = temp_dir / 'a.log'
+    path.write_bytes(b'ERROR old\n')
+    wf = watched_file(path)
+    wf.run(timestamp=1)
+    with path.open('ab') as f:
+        f.write(b'ERROR last old\n')
+    path.rename(temp_dir / 'a.log.1')
+    path.write_bytes(b'ERROR new\n')
+    wf.run(timestamp=2)
+    assert wf.f is None
+    wf.run(timestamp=3)
+    assert [entry.line for entry in wf.error_lines] == ['ERROR old', 'ERROR last old', 'ERROR new']
+
+
+
+def test_error_lines_dedup_and_truncation():
+    from overwatch_basic_agents.log_agent import ErrorLineRetention, ErrorLines
+    error_lines = ErrorLines(ErrorLineRetention({'max_line_length': 20}))
+    error_lines.add('ERROR request 123 failed', 1, key='1:0')
+    error_lines.add('ERROR request 456 failed', 5, key='5:1')
+    error_lines.add('ERROR ' + 'x' * 10**6, 6, key='6:2')
+    entry, long_entry = error_lines
+    assert entry.line == 'ERROR request 123 fa'
+    assert entry.count == 2
+    assert (entry.first_seen, entry.last_seen) == (1, 5)
+    assert long_entry.line == 'ERROR ' + 'x' * 14
+    assert long_entry.line_length == 10**6 + 6
+    assert error_lines.last_timestamp == 6
+
+
+def test_error_lines_budget():
+    from overwatch_basic_agents.log_agent import ErrorLineRetention, ErrorLines
+    error_lines = ErrorLines(ErrorLineRetention({'max_entries': 5, 'max_bytes': 1000}))
+    for n in range(1000):
+        error_lines.add('ERROR {} {}'.format('abcdefghijklmnopqrstuvwxyz'[n % 26] * (n % 50 + 1), n), n, key=str(n))
+    assert 1 <= len(error_lines) <= 5
+    assert error_lines.total_bytes <= 1000
+    assert error_lines.total_bytes == sum(entry.size for entry in error_lines)
+    assert error_lines.distinct_seen > 26
+
+
+
+def test_error_lines_sampling_is_uniform_across_distinct_messages():
+    import random
+    from overwatch_basic_agents.log_agent import ErrorLineRetention, ErrorLines
+    random.seed(0)
+    trials = 100
+    repeated_kept = 0
+    for trial in range(trials):
+        error_lines = ErrorLines(ErrorLineRetention({'max_entries': 10}))
+        for n in range(100):
+            # rare messages must differ in more than numbers
+            error_lines.add('ERROR rare ' + ''.join(chr(ord('g') + int(d)) for d in str(n)), 1, key=str(n))
+            for i in range(5):
+                error_lines.add('ERROR repeated {}'.format(i), 1, key='r')
+        repeated_kept += any(entry.line.startswith('ERROR repeated') for entry in error_lines)
+        assert error_lines.distinct_seen == 101
+        assert error_lines.dropped_count == 91
+    # uniform sampling keeps the repeated message with probability 10 / 101
+    assert repeated_kept / trials < 0.3
+
+
+def test_parallel_scan_with_process_pool(temp_dir):
+    from overwatch_basic_agents.log_agent import Configuration, LogAgent
+    for n in range(3):
+        (temp_dir / '{}.log'.format(n)).write_bytes(b'ok\nERROR x\n' * 100)
+    conf_path = temp_dir / 'conf.yaml'
+    conf_path.write_text(
+        'overwatch_log_agent:\n'
+        '  report_url: http://localhost:4/report\n'
+        '  report_token: secret\n'
+        '  scan: {workers: 2, process_pool: true, chunk_size: 64}\n'
+        '  log_files:\n' + ''.join(
+        '    - path: {}.log\n'
+        '      error_patterns: [{{regex: ERROR}}]\n'.format(n) for n in range(3)))
+    sender = DummySender()
+    agent = LogAgent(Configuration(conf_path), sender)
+    try:
+        agent.run_iteration()
+    finally:
+        agent._shutdown_pools()
+    assert [next(wf.line_counter) for wf in agent.wfs] == [100] * 3
+    assert len(sender.reports[0]['state']['log_files']) == 3
+
+
+def test_process_pool_requires_python_37(monkeypatch):
+    import sys
+    from pytest import raises
+    from overwatch_basic_agents.log_agent import Scan
+    assert Scan({'process_pool': True}).process_pool
+    monkeypatch.setattr(sys, 'version_info', (3, 6, 9))
+    with raises(Exception, match='requires Python 3.7'):
+        Scan({'process_pool': True})
+    assert not Scan({}).process_pool
@@ -0,0 +1,43 @@
+import threading
+
+
+def test_create_agents_from_sample_configuration(project_dir):
+    from overwatch_basic_agents.helpers import ReportSender
+    from overwatch_basic_agents.multi_agent import create_agents
+    sender = ReportSender()
+    agents = create_agents(project_dir / 'sample_configuration.yaml', sender)
+    assert [a.name for a in agents] == ['system', 'web', 'log']
+    assert all(a.sender is sender for a in agents)
+
+
+def test_scheduler_isolates_failing_agent():
+    from overwatch_basic_agents.multi_agent import Scheduler
+
+    class FailingAgent:
+        name = 'failing'
+        sleep_interval = 0.01
+        def run_iteration(self):
+            raise Exception('Test failure')
+
+    class CountingAgent:
+        name = 'counting'
+        sleep_interval = 0.01
+        def __init__(self):
+            self.done = threading.Event()
+            self.count = 0
+        def run_iteration(self):
+            self.count += 1
+            if self.count >= 5:
+                self.done.set()
+
+    counting_agent = CountingAgent()
+    scheduler = Scheduler([FailingAgent(), counting_agent])
+    t = threading.Thread(target=scheduler.run)
+    t.start()
+    try:
+        assert counting_agent.done.wait(5)
+    finally:
+        scheduler.stop()
+        t.join()
+    assert scheduler.failure_counts[0] >= 1
+    assert scheduler.failure_counts[1] == 0
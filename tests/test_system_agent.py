@@ -7,3 +7,75 @@ def test_load_sample_configuration(project_dir):
 def test_gather_state():
     from overwatch_basic_agents.system_agent import gather_state
     assert gather_state(conf=None)
+
+
+def test_gather_processes():
+    import os
+    from overwatch_basic_agents.system_agent import ProcessScanner, Processes, gather_processes
+    scanner = ProcessScanner()
+    proc_conf = Processes({'top_n': 100000})
+    data = gather_processes(proc_conf, scanner=scanner)
+    assert data['scanned_count'] > 0
+    assert not data['scan_truncated']
+    assert os.getpid() in [p['pid'] for p in data['top_rss'].values()]
+    # CPU usage is known only after the second scan
+    data = gather_processes(proc_conf, scanner=scanner)
+    assert os.getpid() in [p['pid'] for p in data['top_cpu'].values()]
+
+
+def test_process_scan_time_limit():
+    from overwatch_basic_agents.system_agent import ProcessScanner
+    scanner = ProcessScanner()
+    processes, total_count, truncated = scanner.scan(time_limit=-1)
+    assert truncated
+    assert processes == []
+    assert total_count > 0
+
+
+def test_gather_pressure(temp_dir):
+    from overwatch_basic_agents.system_agent import Pressure, gather_pressure
+    (temp_dir / 'cpu').write_text(
+        'some avg10=1.45 avg60=1.44 avg300=0.76 total=3556996\n'
+        'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+    (temp_dir / 'memory').write_text(
+        'some avg10=30.00 avg60=25.00 avg300=1.00 total=1000000\n'
+        'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+    data = gather_pressure(Pressure(None), pressure_path=str(temp_dir))
+    assert data['cpu']['some']['avg60'] == {'__value': 1.44, '__unit': 'percents', '__check': {'state': 'green'}}
+    assert data['cpu']['some']['total'] == {'__value': 3.556996, '__unit': 'seconds', '__counter': True}
+    assert data['memory']['some']['avg60']['__check'] == {'state': 'red'}
+    assert 'io' not in data
+
+
+def test_gather_cgroup(temp_dir):
+    from overwatch_basic_agents.system_agent import CGroup, Pressure, gather_cgroups
+    cg_dir = temp_dir / 'system.slice' / 'docker.service'
+    cg_dir.mkdir(parents=True)
+    (cg_dir / 'cpu.stat').write_text('usage_usec 2000000\nnr_throttled 3\n')
+    (cg_dir / 'memory.current').write_text('950\n')
+    (cg_dir / 'memory.max').write_text('1000\n')
+    (cg_dir / 'io.stat').write_text('8:0 rbytes=4096 wbytes=0 rios=1 wios=0 dbytes=0 dios=0\n')
+    cgroups = [
+        CGroup({'path': 'system.slice/docker.service', 'name': 'docker'}, cgroup_root=temp_dir),
+        CGroup({'path': 'missing.slice'}, cgroup_root=temp_dir),
+    ]
+    data = gather_cgroups(cgroups, Pressure(None))
+    docker = data['docker']
+    assert docker['error']['__check'] == {'state': 'green'}
+    assert docker['cpu']['usage'] == {'__value': 2.0, '__unit': 'seconds', '__counter': True}
+    assert docker['cpu']['nr_throttled'] == {'__value': 3, '__counter': True}
+    assert docker['memory']['percent']['__check'] == {'state': 'red'}
+    assert docker['io']['8:0']['rbytes']['__value'] == 4096
+    assert data[str(temp_dir / 'missing.slice')]['error']['__check'] == {'state': 'red'}
+
+
+def test_sampler():
+    from overwatch_basic_agents.system_agent import Sampler
+    sampler = Sampler(interval=1, window=15)
+    sampler.sample()
+    sampler.sample()
+    data = sampler.collect()
+    assert data['count'] == 2
+    assert data['cpu_percent']['max']['__unit'] == 'percents'
+    assert data['memory_available_bytes']['p95']['__value'] > 0
+    assert sampler.collect()['count'] == 0
@@ -1,3 +1,5 @@
+from pytest import fixture, raises
+
 
 def test_load_sample_configuration(project_dir):
     from overwatch_basic_agents.web_agent import Configuration
@@ -16,3 +18,222 @@ def test_check_nonexisting_target():
     assert report_state['name'] == 'Test'
     assert report_state['url'] == 'http://localhost:4/test'
     assert report_state['duration_seconds']
+
+
+@fixture
+def etag_server():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import gzip
+    from threading import Thread
+    requests_seen = []
+
+    class Handler (BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            requests_seen.append(('GET', self.headers.get('If-None-Match')))
+            if self.path == '/gzip':
+                body = gzip.compress(b'Pong ' * 1000)
+                self.send_response(200)
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+            body = b'Pong ' * 100
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_HEAD(self):
+            requests_seen.append(('HEAD', None))
+            self.send_response(200)
+            self.send_header('Content-Length', '500')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.requests_seen = requests_seen
+    httpd.url = 'http://127.0.0.1:{}/'.format(httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_check_target_conditional(etag_server):
+    import requests
+    from overwatch_basic_agents.web_agent import Target, check_target
+    target = Target({'url': etag_server.url, 'request_mode': 'conditional', 'response_contains': 'Pong'})
+    rs = requests.session()
+    first, second = {}, {}
+    check_target(rs, target, first)
+    check_target(rs, target, second)
+    assert etag_server.requests_seen == [('GET', None), ('GET', '"v1"')]
+    assert first['response']['validation'] == 'downloaded'
+    assert first['response']['transferred_bytes'] == 500
+    assert second['response']['validation'] == 'revalidated'
+    assert second['response']['transferred_bytes'] == 0
+    assert second['response']['status_code']['__value'] == 200
+    assert second['response']['content_length'] == 500
+    assert second['response']['content_verified_date'] == first['response']['content_verified_date']
+    assert second['response_contains']['present']['__value'] is True
+
+
+def test_transferred_bytes_of_compressed_response(etag_server):
+    import gzip
+    import requests
+    from overwatch_basic_agents.web_agent import Target, check_target
+    report_state = {}
+    check_target(requests.session(), Target({'url': etag_server.url + 'gzip'}), report_state)
+    assert report_state['response']['content_length'] == 5000
+    assert report_state['response']['transferred_bytes'] == len(gzip.compress(b'Pong ' * 1000))
+
+
+def test_check_target_head(etag_server):
+    import requests
+    from overwatch_basic_agents.web_agent import Target, check_target
+    target = Target({'url': etag_server.url, 'request_mode': 'head'})
+    report_state = {}
+    check_target(requests.session(), target, report_state)
+    assert etag_server.requests_seen == [('HEAD', None)]
+    assert report_state['response']['validation'] == 'head'
+    assert report_state['response']['content_length'] == 500
+    assert report_state['response']['transferred_bytes'] == 0
+
+
+def test_head_with_response_contains_is_rejected():
+    from overwatch_basic_agents.web_agent import Target
+    with raises(Exception):
+        Target({'url': 'http://localhost/', 'request_mode': 'head', 'response_contains': 'Pong'})
+
+
+def test_adaptive_timeout():
+    from overwatch_basic_agents.web_agent import Backoff, TargetHealth
+    backoff = Backoff({'timeout': 10, 'min_timeout': 1, 'latency_multiplier': 4})
+    health = TargetHealth()
+    assert health.timeout(backoff) == 10
+    for i in range(5):
+        health.record_success(0.5)
+    assert health.timeout(backoff) == 2
+    health.record_failure('timeout', backoff, sleep_interval=30)
+    assert health.timeout(backoff) == 2
+    for i in range(20):
+        health.record_success(0.01)
+    assert health.timeout(backoff) == 1
+    for i in range(20):
+        health.record_success(5)
+    assert health.timeout(backoff) == 10
+
+
+def test_down_targets_are_probed_within_budget():
+    import requests
+    from overwatch_basic_agents.web_agent import Backoff, Target, check_target_with_backoff, select_probed_targets
+    backoff = Backoff({'down_after_failures': 2, 'probe_budget': 1})
+    targets = [Target({'url': 'http://127.0.0.1:4/a'}), Target({'url': 'http://127.0.0.1:4/b'})]
+    rs = requests.session()
+    for i in range(2):
+        for target in targets:
+            report_state = {}
+            check_target_with_backoff(rs, target, report_state, backoff, sleep_interval=0)
+            assert report_state['availability']['check'] == 'full'
+    assert all(t.health.is_down(backoff) for t in targets)
+    probed = select_probed_targets(targets, backoff)
+    assert len(probed) == 1
+    states = {}
+    for target in targets:
+        states[target.url] = {}
+        check_target_with_backoff(rs, target, states[target.url], backoff, sleep_interval=0, probe=target in probed)
+    probed_state = states[probed[0].url]
+    assert probed_state['availability']['check'] == 'probe'
+    assert probed_state['error']['__value'].startswith('TCP probe failed')
+    assert probed_state['availability']['consecutive_failures'] == 3
+    deferred_state, = [st for url, st in states.items() if url != probed[0].url]
+    assert deferred_state['availability']['check'] == 'deferred'
+    assert deferred_state['error']['__check']['state'] == 'red'
+    assert deferred_state['availability']['consecutive_failures'] == 2
+
+
+def test_check_session_does_not_keep_cookies():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from threading import Thread
+    from overwatch_basic_agents.web_agent import Target, check_target, create_check_session
+    cookies_seen = []
+
+    class Handler (BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            cookies_seen.append(self.headers.get('Cookie'))
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'sid=abc; Path=/')
+            self.send_header('Content-Length', '4')
+            self.end_headers()
+            self.wfile.write(b'Pong')
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        target = Target({'url': 'http://127.0.0.1:{}/'.format(httpd.server_address[1])})
+        rs = create_check_session(2)
+        for i in range(2):
+            report_state = {}
+            check_target(rs, target, report_state)
+            assert report_state['response']['status_code']['__value'] == 200
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert cookies_seen == [None, None]
+    assert len(rs.cookies) == 0
+
+
+def test_slower_target_is_retried_with_full_timeout():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from threading import Thread
+    from time import sleep
+    import requests
+    from overwatch_basic_agents.web_agent import Backoff, Target, check_target_with_backoff
+    delay = [0.02]
+
+    class Handler (BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            sleep(delay[0])
+            self.send_response(200)
+            self.send_header('Content-Length', '4')
+            self.end_headers()
+            self.wfile.write(b'Pong')
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        backoff = Backoff({'timeout': 5, 'min_timeout': 0.2})
+        target = Target({'url': 'http://127.0.0.1:{}/'.format(httpd.server_address[1])})
+        rs = requests.session()
+        for i in range(6):
+            check_target_with_backoff(rs, target, {}, backoff, sleep_interval=30)
+        assert target.health.timeout(backoff) == 0.2
+        delay[0] = 0.5
+        report_state = {}
+        check_target_with_backoff(rs, target, report_state, backoff, sleep_interval=30)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert 'timed out' in report_state['short_timeout_error']
+    assert report_state['timeout_seconds'] == 5
+    assert report_state['error']['__check']['state'] == 'green'
+    assert report_state['response']['status_code']['__value'] == 200
+    assert target.health.consecutive_failures == 0